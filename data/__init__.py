@@ -3,4 +3,5 @@
 # email: playinf@stu.xmu.edu.cn
 
 from reader import textreader
-from iterator import textiterator
+from iterator import textiterator, bucketiterator
+from prefetch import prefetcher
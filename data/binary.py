@@ -0,0 +1,172 @@
+# binary.py
+# binarized corpus, every side of a parallel corpus is stored as a
+# memory-mapped file (see utils/checkpoint.py) with three tensors:
+#   ids: int32 token ids of all sentences, without <eos>
+#   offsets: int64 position of each sentence in ids
+#   lengths: int32 number of tokens of each sentence
+# author: Playinf
+# email: playinf@stu.xmu.edu.cn
+
+import numpy
+
+from utils.checkpoint import is_mmap_checkpoint, create_mmap, load_mmap
+
+
+__all__ = ["is_binary_corpus", "binarize", "binaryreader", "convert_ids"]
+
+
+def is_binary_corpus(name):
+    return is_mmap_checkpoint(name)
+
+
+# writes a text file as a binarized corpus, out-of-vocabulary words are
+# mapped to unk
+def binarize(name, output, voc, unk="UNK", eos="<eos>"):
+    unkid = voc[unk]
+    nline = 0
+    ntoken = 0
+
+    # first pass counts sentences and tokens
+    fd = open(name, "r")
+
+    for line in fd:
+        nline += 1
+        ntoken += len(line.split())
+
+    fd.close()
+
+    header = {"vocab_size": len(voc), "unk": unk, "eos": eos}
+    specs = [("ids", "int32", [ntoken]), ("offsets", "int64", [nline]),
+             ("lengths", "int32", [nline])]
+    ids, offsets, lengths = [val for key, val in
+                             create_mmap(output, header, specs)]
+
+    fd = open(name, "r")
+    offset = 0
+
+    for i, line in enumerate(fd):
+        words = line.split()
+        n = len(words)
+        ids[offset:offset + n] = [voc[w] if w in voc else unkid
+                                  for w in words]
+        offsets[i] = offset
+        lengths[i] = n
+        offset += n
+
+    fd.close()
+
+    for val in [ids, offsets, lengths]:
+        if isinstance(val, numpy.memmap):
+            val.flush()
+
+    return nline, ntoken
+
+
+# same as textreader, yields numpy arrays of token ids instead of lines,
+# sentences are views of memory-mapped files and never copied
+class binaryreader:
+
+    def __init__(self, name, shuffle=False):
+        if not isinstance(name, (list, tuple)):
+            name = [name]
+
+        stream = []
+        headers = []
+
+        for item in name:
+            header, tensors = load_mmap(item, "r")
+            headers.append(header)
+            stream.append(dict(tensors))
+
+        linecnt = min([len(item["lengths"]) for item in stream])
+
+        if shuffle:
+            if not isinstance(shuffle, bool):
+                randstate = numpy.random.RandomState(shuffle)
+                shuffle = randstate.shuffle
+            else:
+                shuffle = numpy.random.shuffle
+
+            indices = numpy.arange(linecnt)
+            shuffle(indices)
+        else:
+            indices = None
+            shuffle = False
+
+        self.eos = False
+        self.count = 0
+        self.names = name
+        self.headers = headers
+        self.stream = stream
+        self.linecnt = linecnt
+        self.indices = indices
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.next()
+
+    def readline(self):
+        # end of file
+        if self.count == self.linecnt:
+            return None
+
+        if self.shuffle:
+            index = self.indices[self.count]
+        else:
+            index = self.count
+
+        self.count += 1
+        data = []
+
+        for item in self.stream:
+            offset = item["offsets"][index]
+            data.append(item["ids"][offset:offset + item["lengths"][index]])
+
+        return data
+
+    def next(self):
+        data = self.readline()
+
+        if data is None:
+            self.reset()
+            raise StopIteration
+
+        return data
+
+    def reset(self):
+        self.count = 0
+        self.eos = False
+
+        if self.shuffle:
+            indices = numpy.arange(self.linecnt)
+            self.shuffle(indices)
+            self.indices = indices
+
+    def close(self):
+        self.stream = [{} for item in self.stream]
+
+    def get_indices(self):
+        return self.indices
+
+    def set_indices(self, indices):
+        self.indices = indices
+
+
+# same as convert_data, data is a list of token id arrays
+def convert_ids(data, eos, dtype="float32"):
+    batch = len(data)
+    data_len = [len(item) + 1 for item in data]
+    max_len = max(data_len)
+
+    seq = numpy.zeros((max_len, batch), "int32")
+    mask = numpy.zeros((max_len, batch), dtype)
+
+    for idx, item in enumerate(data):
+        seq[:data_len[idx] - 1, idx] = item
+        seq[data_len[idx] - 1, idx] = eos
+        mask[:data_len[idx], idx] = 1.0
+
+    return seq, mask
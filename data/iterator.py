@@ -7,7 +7,11 @@ import numpy
 
 class textiterator:
 
-    def __init__(self, reader, size, processor=None, maxlen=None, sort=False):
+    # tokens: maximum number of tokens of each stream in a batch, counted by
+    # processor plus one <eos> per sentence and including padding, size[0]
+    # is the maximum number of sentences
+    def __init__(self, reader, size, processor=None, maxlen=None, sort=False,
+                 tokens=None):
         if not isinstance(size, (list, tuple)) or len(size) != 2:
             raise ValueError("size must be format (batch_size, buffer_size)")
 
@@ -17,7 +21,7 @@ class textiterator:
         if processor and not isinstance(processor, (list, tuple)):
             processor = [processor]
 
-        if not processor and (maxlen or sort):
+        if not processor and (maxlen or sort or tokens):
             raise ValueError("length processor must provided")
 
         if processor and len(processor) != len(reader.stream):
@@ -29,6 +33,12 @@ class textiterator:
         if maxlen and len(maxlen) != len(reader.stream):
             raise ValueError("len(maxlen) != len(reader.stream)")
 
+        if tokens and not isinstance(tokens, (list, tuple)):
+            tokens = [tokens for i in range(len(reader.stream))]
+
+        if tokens and len(tokens) != len(reader.stream):
+            raise ValueError("len(tokens) != len(reader.stream)")
+
         data = [[] for i in range(len(reader.stream))]
 
         self.end = False
@@ -36,6 +46,7 @@ class textiterator:
         self.size = size
         self.sort = sort
         self.limit = maxlen
+        self.tokens = tokens
         self.reader = reader
         self.processor = processor
 
@@ -45,46 +56,51 @@ class textiterator:
     def __next__(self):
         return self.next()
 
-    def read_data(self):
-        data_size = len(self.data[0])
-        batch_size = self.size[0]
-        buffer_size = self.size[1]
+    # appends at most count sentences within the length limit to buffer,
+    # returns False at the end of file
+    def fill_buffer(self, buffer, count):
+        while count:
+            new_data = self.reader.readline()
 
-        # fill buffer
-        if batch_size > data_size:
-            count = buffer_size - data_size
+            # end of file
+            if not new_data:
+                return False
 
-            while count:
-                new_data = self.reader.readline()
+            if self.limit and self.processor:
+                ndata = len(new_data)
+                exceed_lim = False
 
-                # end of file
-                if not new_data:
-                    break
+                for i in range(ndata):
+                    if not self.limit[i]:
+                        continue
 
-                if self.limit and self.processor:
-                    ndata = len(new_data)
-                    exceed_lim = False
+                    if self.processor[i](new_data[i]) == 0:
+                        exceed_lim = True
+                        break
 
-                    for i in range(ndata):
-                        if not self.limit[i]:
-                            continue
+                    if self.processor[i](new_data[i]) > self.limit[i]:
+                        exceed_lim = True
+                        break
 
-                        if self.processor[i](new_data[i]) == 0:
-                            exceed_lim = True
-                            break
+                if exceed_lim:
+                    continue
 
-                        if self.processor[i](new_data[i]) > self.limit[i]:
-                            exceed_lim = True
-                            break
+            # add to buffer
+            for bdata, data in zip(buffer, new_data):
+                bdata.append(data)
 
-                    if exceed_lim:
-                        continue
+            count -= 1
+
+        return True
 
-                # add to buffer
-                for bdata, data in zip(self.data, new_data):
-                    bdata.append(data)
+    def read_data(self):
+        data_size = len(self.data[0])
+        batch_size = self.size[0]
+        buffer_size = self.size[1]
 
-                count -= 1
+        # fill buffer
+        if batch_size > data_size:
+            self.fill_buffer(self.data, buffer_size - data_size)
 
             # sort batch data
             if self.sort:
@@ -104,6 +120,9 @@ class textiterator:
 
         new_data_size = len(self.data[0])
 
+        if self.tokens and new_data_size:
+            batch_size = self.fit_tokens(self.data, batch_size)
+
         if new_data_size == 0:
             return None
         elif batch_size > new_data_size:
@@ -115,6 +134,23 @@ class textiterator:
             self.data = [item[batch_size:] for item in self.data]
             return data
 
+    # number of sentences at the front of buffer within the token limit
+    def fit_tokens(self, buffer, batch_size):
+        size = min(batch_size, len(buffer[0]))
+        maxlen = [0 for i in range(len(buffer))]
+
+        for i in range(size):
+            for j, (getlen, data) in enumerate(zip(self.processor, buffer)):
+                maxlen[j] = max(maxlen[j], getlen(data[i]))
+
+            for n, limit in zip(maxlen, self.tokens):
+                # a batch has at least one sentence, <eos> is appended to
+                # every sentence by convert_data
+                if limit and i > 0 and (n + 1) * (i + 1) > limit:
+                    return i
+
+        return size
+
     def next(self):
         data = self.read_data()
 
@@ -129,3 +165,79 @@ class textiterator:
 
     def close(self):
         self.reader.close()
+
+
+# same as textiterator, sentences of a pool of size[1] are assigned to
+# buckets by length and cut into batches, batches of all buckets are
+# emitted in random order, incomplete batches are kept for the next pool
+# width: length range of a bucket
+# seed: seed of the batch order
+class bucketiterator(textiterator):
+
+    def __init__(self, reader, size, processor, maxlen=None, sort=False,
+                 tokens=None, width=5, seed=None):
+        textiterator.__init__(self, reader, size, processor, maxlen, sort,
+                              tokens)
+
+        if width <= 0:
+            raise ValueError("bucket width must > 0")
+
+        self.width = width
+        self.buckets = {}
+        self.batches = []
+        self.random = numpy.random.RandomState(seed)
+
+    def length(self, data):
+        return max([getlen(item) for getlen, item in zip(self.processor,
+                                                           data)])
+
+    def fill_batches(self):
+        nstream = len(self.reader.stream)
+        pool = [[] for i in range(nstream)]
+        end = not self.fill_buffer(pool, self.size[1])
+
+        for data in zip(*pool):
+            key = self.length(data) / self.width
+            self.buckets.setdefault(key, []).append(data)
+
+        batches = []
+
+        for key in sorted(self.buckets):
+            bucket = sorted(self.buckets[key], key=self.length)
+
+            while bucket:
+                n = min(self.size[0], len(bucket))
+
+                if self.tokens:
+                    buffer = [list(item) for item in zip(*bucket[:n])]
+                    n = self.fit_tokens(buffer, n)
+
+                # an incomplete batch waits for the next pool
+                if n == len(bucket) and n < self.size[0] and not end:
+                    break
+
+                batches.append([list(item) for item in zip(*bucket[:n])])
+                bucket = bucket[n:]
+
+            if bucket:
+                self.buckets[key] = bucket
+            else:
+                del self.buckets[key]
+
+        self.random.shuffle(batches)
+        self.batches = batches
+
+    def read_data(self):
+        while not self.batches:
+            self.fill_batches()
+
+            # nothing left in the pool and buckets
+            if not self.batches and not self.buckets:
+                return None
+
+        return self.batches.pop()
+
+    def reset(self):
+        self.buckets = {}
+        self.batches = []
+        self.reader.reset()
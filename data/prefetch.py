@@ -0,0 +1,154 @@
+# prefetch.py
+# author: Playinf
+# email: playinf@stu.xmu.edu.cn
+
+import time
+import multiprocessing
+
+
+def prefetch_loop(stream, processor, queue, conn):
+    reader = stream.reader
+
+    while True:
+        command = conn.recv()
+
+        try:
+            if command == "epoch":
+                for data in stream:
+                    if processor:
+                        data = processor(data)
+                    queue.put((data, reader.count))
+                    # the epoch is interrupted by reset
+                    if conn.poll():
+                        break
+                # textiterator resets the reader at the end of an epoch
+                queue.put((None, (reader.count, reader.get_indices())))
+            elif command == "stop":
+                pass
+            elif command == "reset":
+                stream.reset()
+                conn.send((reader.count, reader.get_indices()))
+            elif command == "close":
+                stream.close()
+                break
+        except Exception as e:
+            queue.put((e, None))
+
+
+# reads and processes batches of a textiterator in a separate process
+# processor: applied to each batch in that process
+# size: maximum number of prepared batches, 0 to read synchronously
+class prefetcher(object):
+
+    def __init__(self, stream, processor=None, size=16):
+        reader = stream.reader
+
+        self.stream = stream
+        self.processor = processor
+        self.size = size
+        # seconds spent waiting for data since the last reset
+        self.wait_time = 0.0
+        # state of the reader after the last returned batch
+        self.count = reader.count
+        self.indices = reader.get_indices()
+        self.running = False
+
+        if size > 0:
+            conn, child_conn = multiprocessing.Pipe()
+            queue = multiprocessing.Queue(size)
+            args = (stream, processor, queue, child_conn)
+            process = multiprocessing.Process(target=prefetch_loop,
+                                              args=args)
+            process.daemon = True
+            process.start()
+            self.conn = conn
+            self.queue = queue
+            self.process = process
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.next()
+
+    def get_indices(self):
+        return self.indices
+
+    def read_sync(self):
+        reader = self.stream.reader
+
+        try:
+            data = self.stream.next()
+        except StopIteration:
+            self.count = reader.count
+            self.indices = reader.get_indices()
+            raise
+
+        if self.processor:
+            data = self.processor(data)
+
+        self.count = reader.count
+
+        return data
+
+    def next(self):
+        t1 = time.time()
+
+        if self.size == 0:
+            data = self.read_sync()
+            self.wait_time += time.time() - t1
+            return data
+
+        if not self.running:
+            self.conn.send("epoch")
+            self.running = True
+
+        data, state = self.queue.get()
+        self.wait_time += time.time() - t1
+
+        if isinstance(data, Exception):
+            self.running = False
+            raise data
+
+        if data is None:
+            self.running = False
+            self.count, self.indices = state
+            raise StopIteration
+
+        self.count = state
+
+        return data
+
+    # discards prefetched batches of an unfinished epoch
+    def stop(self):
+        if not self.running:
+            return
+
+        self.conn.send("stop")
+
+        while self.running:
+            data, state = self.queue.get()
+            if data is None or isinstance(data, Exception):
+                self.running = False
+
+    def reset(self):
+        self.wait_time = 0.0
+
+        if self.size == 0:
+            self.stream.reset()
+            self.count = self.stream.reader.count
+            self.indices = self.stream.reader.get_indices()
+            return
+
+        self.stop()
+        self.conn.send("reset")
+        self.count, self.indices = self.conn.recv()
+
+    def close(self):
+        if self.size == 0:
+            self.stream.close()
+            return
+
+        self.stop()
+        self.conn.send("close")
+        self.process.join()
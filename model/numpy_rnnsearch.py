@@ -0,0 +1,260 @@
+# numpy_rnnsearch.py
+# RNNsearch inference implemented with NumPy, no Theano compilation needed
+# author: Playinf
+# email: playinf@stu.xmu.edu.cn
+
+import numpy
+
+
+def sigmoid(x):
+    # numerically stable
+    return 0.5 * (numpy.tanh(0.5 * x) + 1.0)
+
+
+def log_softmax(x):
+    x = x - numpy.max(x, 1)[:, None]
+    return x - numpy.log(numpy.sum(numpy.exp(x), 1))[:, None]
+
+
+def topk(log_probs, k):
+    # unsorted, same as Theano's topk_and_argtopk(sorted=False)
+    k = min(k, log_probs.shape[1])
+    indices = numpy.argpartition(-log_probs, k - 1, 1)[:, :k]
+    rows = numpy.arange(log_probs.shape[0])[:, None]
+    values = log_probs[rows, indices]
+
+    return values, indices.astype("int32")
+
+
+# weights of gru_cell are concatenated into the layout of fused_gru_cell
+def fuse_gru(params, prefix):
+    if prefix + "/fused_gru_cell/gates/matrix" in params:
+        matrix = params[prefix + "/fused_gru_cell/gates/matrix"]
+        bias = params[prefix + "/fused_gru_cell/gates/bias"]
+        return matrix, bias
+
+    prefix = prefix + "/gru_cell"
+    rows = []
+    i = 0
+
+    while prefix + "/reset_gate/matrix_%d" % i in params:
+        gates = ["reset_gate", "update_gate", "candidate"]
+        gates = [params["%s/%s/matrix_%d" % (prefix, g, i)] for g in gates]
+        rows.append(numpy.concatenate(gates, 1))
+        i += 1
+
+    matrix = numpy.concatenate(rows, 0)
+    bias = params[prefix + "/candidate/bias"]
+    zeros = numpy.zeros_like(bias)
+    bias = numpy.concatenate([zeros, zeros, bias], 0)
+
+    return matrix, bias
+
+
+class gru(object):
+
+    def __init__(self, matrix, bias, input_size):
+        self.size = matrix.shape[1] / 3
+        self.bias = bias
+        self.matrices = []
+        offset = 0
+
+        for n in input_size:
+            self.matrices.append(matrix[offset:offset + n])
+            offset += n
+
+        self.recurrent = matrix[offset:]
+
+    # projections of the leading inputs, works on sequences
+    def project(self, inputs):
+        x = self.bias
+
+        for item, w in zip(inputs, self.matrices):
+            x = x + numpy.dot(item, w)
+
+        return x
+
+    def update(self, x, inputs, state):
+        size = self.size
+        n = len(self.matrices) - len(inputs)
+
+        for item, w in zip(inputs, self.matrices[n:]):
+            x = x + numpy.dot(item, w)
+
+        h = numpy.dot(state, self.recurrent[:, :2 * size])
+        r = sigmoid(x[:, :size] + h[:, :size])
+        u = sigmoid(x[:, size:2 * size] + h[:, size:])
+        c = numpy.dot(r * state, self.recurrent[:, 2 * size:])
+        c = numpy.tanh(x[:, 2 * size:] + c)
+
+        return (1.0 - u) * state + u * c
+
+
+# option, params: outputs of load_model in rnnsearch.py
+# provides the decoding interface of model.rnnsearch.rnnsearch
+class numpy_rnnsearch(object):
+
+    def __init__(self, option, params):
+        sedim, tedim = option["embdim"]
+        shdim, thdim, ahdim = option["hidden"]
+
+        # variable names without the model scope
+        params = dict([("/".join(name.split("/")[1:]), val)
+                       for name, val in params])
+
+        self.option = option
+        self.maxpart = option["maxpart"]
+
+        self.source_embedding = params["source_embedding/embedding"]
+        self.source_bias = params["source_embedding/bias"]
+        self.target_embedding = params["target_embedding/embedding"]
+        self.target_bias = params["target_embedding/bias"]
+
+        args = fuse_gru(params, "encoder/forward") + ([sedim],)
+        self.forward = gru(*args)
+        args = fuse_gru(params, "encoder/backward") + ([sedim],)
+        self.backward = gru(*args)
+        args = fuse_gru(params, "decoder") + ([tedim, 2 * shdim],)
+        self.cell = gru(*args)
+
+        self.initial_w = params["decoder/initial/matrix_0"]
+        self.initial_b = params["decoder/initial/bias"]
+        self.attention_w = params["decoder/attention/attention_w/matrix_0"]
+        self.query_w = params["decoder/attention/query_w/matrix_0"]
+        self.attention_v = params["decoder/attention/attention_v/matrix_0"]
+        self.maxout_w = [params["decoder/maxout/matrix_%d" % i]
+                         for i in range(3)]
+        self.maxout_b = params["decoder/maxout/bias"]
+        self.deepout_w = params["decoder/deepout/matrix_0"]
+        self.logits_w = params["decoder/logits/matrix_0"]
+        self.logits_b = params["decoder/logits/bias"]
+
+    def _run_encoder(self, cell, inputs, mask):
+        state = numpy.zeros([inputs.shape[1], cell.size], inputs.dtype)
+        projections = cell.project([inputs])
+        states = []
+
+        for x, m in zip(projections, mask):
+            m = m[:, None]
+            state = (1.0 - m) * state + m * cell.update(x, [], state)
+            states.append(state)
+
+        return numpy.array(states)
+
+    # returns [annotation, initial_state, mapped_states]
+    def encode(self, seq, mask):
+        inputs = self.source_embedding[seq] + self.source_bias
+        fd_states = self._run_encoder(self.forward, inputs, mask)
+        bd_states = self._run_encoder(self.backward, inputs[::-1], mask[::-1])
+        bd_states = bd_states[::-1]
+        annotation = numpy.concatenate([fd_states, bd_states], 2)
+        initial_state = numpy.dot(bd_states[0], self.initial_w)
+        initial_state = numpy.tanh(initial_state + self.initial_b)
+        mapped_states = numpy.dot(annotation, self.attention_w)
+
+        return [annotation, initial_state, mapped_states]
+
+    def _embed(self, prev_words):
+        inputs = self.target_embedding[prev_words] + self.target_bias
+        # zeros out embedding if y is 0
+        return inputs * (prev_words != 0)[:, None]
+
+    def _attention(self, state, annotation, mapped_states, mask):
+        mapped_query = numpy.dot(state, self.query_w)
+        hidden = numpy.tanh(mapped_query[None, :, :] + mapped_states)
+        score = numpy.dot(hidden, self.attention_v)[:, :, 0]
+        exp_score = numpy.exp(score) * mask
+        alpha = exp_score / numpy.sum(exp_score, 0)
+        context = numpy.sum(alpha[:, :, None] * annotation, 0)
+
+        return alpha, context
+
+    def _logits(self, inputs, state, context, candidates=None):
+        features = [state, inputs, context]
+        maxhid = self.maxout_b
+
+        for x, w in zip(features, self.maxout_w):
+            maxhid = maxhid + numpy.dot(x, w)
+
+        shape = [maxhid.shape[0], -1, self.maxpart]
+        maxhid = numpy.max(maxhid.reshape(shape), 2)
+        readout = numpy.dot(maxhid, self.deepout_w)
+
+        if candidates is None:
+            return numpy.dot(readout, self.logits_w) + self.logits_b
+
+        matrix = self.logits_w[:, candidates]
+        bias = self.logits_b[candidates]
+
+        return numpy.dot(readout, matrix) + bias
+
+    def _predict(self, prev_words, state, annotation, mapped_states,
+                 src_mask, indices, candidates=None):
+        inputs = self._embed(prev_words)
+        # annotations are selected instead of being repeated
+        annotation = annotation[:, indices]
+        mapped_states = mapped_states[:, indices]
+        src_mask = src_mask[:, indices]
+        alpha, context = self._attention(state, annotation, mapped_states,
+                                         src_mask)
+        logits = self._logits(inputs, state, context, candidates)
+
+        return [log_softmax(logits), context, alpha]
+
+    def _step(self, prev_words, pointers, prev_state, prev_context,
+              annotation, mapped_states, src_mask, indices, candidates=None):
+        inputs = self._embed(prev_words)
+        state = prev_state[pointers]
+        context = prev_context[pointers]
+        x = self.cell.project([inputs])
+        state = self.cell.update(x, [context], state)
+        outputs = self._predict(prev_words, state, annotation, mapped_states,
+                                src_mask, indices, candidates)
+
+        return outputs + [state]
+
+    def _topk(self, outputs, k):
+        eosid = self.option["eosid"]
+        log_probs = outputs[0]
+        values, word_indices = topk(log_probs, k)
+
+        return [values, word_indices, log_probs[:, eosid]] + outputs[1:]
+
+    def predict(self, prev_words, state, annotation, mapped_states, src_mask,
+                indices):
+        return self._predict(prev_words, state, annotation, mapped_states,
+                             src_mask, indices)
+
+    def predict_topk(self, prev_words, state, annotation, mapped_states,
+                     src_mask, indices, k):
+        outputs = self._predict(prev_words, state, annotation, mapped_states,
+                                src_mask, indices)
+        return self._topk(outputs, k)
+
+    def predict_shortlist(self, prev_words, state, annotation, mapped_states,
+                          src_mask, indices, candidates):
+        return self._predict(prev_words, state, annotation, mapped_states,
+                             src_mask, indices, candidates)
+
+    def generate(self, prev_words, state, context):
+        inputs = self._embed(prev_words)
+        x = self.cell.project([inputs])
+        return self.cell.update(x, [context], state)
+
+    def step(self, prev_words, pointers, prev_state, prev_context,
+             annotation, mapped_states, src_mask, indices):
+        return self._step(prev_words, pointers, prev_state, prev_context,
+                          annotation, mapped_states, src_mask, indices)
+
+    def step_topk(self, prev_words, pointers, prev_state, prev_context,
+                  annotation, mapped_states, src_mask, indices, k):
+        outputs = self._step(prev_words, pointers, prev_state, prev_context,
+                             annotation, mapped_states, src_mask, indices)
+        return self._topk(outputs, k)
+
+    def step_shortlist(self, prev_words, pointers, prev_state, prev_context,
+                       annotation, mapped_states, src_mask, indices,
+                       candidates):
+        return self._step(prev_words, pointers, prev_state, prev_context,
+                          annotation, mapped_states, src_mask, indices,
+                          candidates)
@@ -11,41 +11,48 @@ import theano.sandbox.rng_mrg
 from search import beam, select_nbest
 
 
-def gru_encoder(cell, inputs, mask, initial_state=None, dtype=None):
-    if not isinstance(cell, nn.rnn_cell.rnn_cell):
-        raise ValueError("cell is not an instance of rnn_cell")
+# forward and backward directions are computed in a single scan, which
+# halves the number of sequential steps
+def encoder(cell, inputs, mask, initial_state=None, dtype=None, scope=None):
+    gru_cells = (nn.rnn_cell.gru_cell, nn.rnn_cell.fused_gru_cell)
 
-    if isinstance(inputs, (list, tuple)):
-        raise ValueError("inputs must be a tensor, not list or tuple")
+    if not isinstance(cell, gru_cells):
+        raise ValueError("cell is not an instance of gru_cell")
 
-    def loop_fn(inputs, mask, state):
+    def step(projections, mask, state, variables):
         mask = mask[:, None]
-        output, next_state = cell(inputs, state)
+        next_state = cell.update(projections, [], state, variables)
         next_state = (1.0 - mask) * state + mask * next_state
         return next_state
 
-    if initial_state is None:
-        batch = inputs.shape[1]
-        state_size = cell.state_size
-        initial_state = theano.tensor.zeros([batch, state_size], dtype=dtype)
-
-    seq = [inputs, mask]
-    # ops.scan is a wrapper of theano.scan, which automatically add updates to
-    # optimizer, you can set return_updates=True to behave like Theano's scan
-    states = ops.scan(loop_fn, seq, [initial_state])
-
-    return states
-
+    # args: forward projections, backward projections, masks, states
+    def loop_fn(*args):
+        n = (len(args) - 4) / 2
+        fd_projections = list(args[:n])
+        bd_projections = list(args[n:2 * n])
+        fd_mask, bd_mask, fd_state, bd_state = args[2 * n:]
+        fd_state = step(fd_projections, fd_mask, fd_state, fd_variables)
+        bd_state = step(bd_projections, bd_mask, bd_state, bd_variables)
+        return [fd_state, bd_state]
 
-def encoder(cell, inputs, mask, initial_state=None, dtype=None, scope=None):
     with ops.variable_scope(scope or "encoder", dtype=dtype):
         with ops.variable_scope("forward"):
-            fd_states = gru_encoder(cell, inputs, mask, initial_state, dtype)
+            fd_variables = cell.get_variables()
+            fd_seq = cell.project(inputs, fd_variables)
         with ops.variable_scope("backward"):
-            inputs = inputs[::-1]
-            mask = mask[::-1]
-            bd_states = gru_encoder(cell, inputs, mask, initial_state, dtype)
-            bd_states = bd_states[::-1]
+            bd_variables = cell.get_variables()
+            bd_seq = cell.project(inputs[::-1], bd_variables)
+
+        if initial_state is None:
+            batch = inputs.shape[1]
+            state_size = cell.state_size
+            initial_state = theano.tensor.zeros([batch, state_size],
+                                                dtype=dtype)
+
+        seq = fd_seq + bd_seq + [mask, mask[::-1]]
+        outputs_info = [initial_state, initial_state]
+        fd_states, bd_states = ops.scan(loop_fn, seq, outputs_info)
+        bd_states = bd_states[::-1]
 
     return fd_states, bd_states
 
@@ -90,11 +97,13 @@ def decoder(cell, inputs, mask, initial_state, attention_states,
     dtype = dtype or inputs.dtype
     att_size = [output_size, states_size, attn_size]
 
-    def loop_fn(inputs, mask, state, attn_states, attn_mask, mapped_states):
+    def loop_fn(*args):
+        projections = list(args[:-5])
+        mask, state, attn_states, attn_mask, mapped_states = args[-5:]
         mask = mask[:, None]
         alpha = attention(state, None, mapped_states, attn_mask, att_size)
         context = theano.tensor.sum(alpha[:, :, None] * attn_states, 0)
-        output, next_state = cell([inputs, context], state)
+        next_state = cell.update(projections, [context], state, variables)
         next_state = (1.0 - mask) * state +  mask * next_state
 
         return [next_state, context]
@@ -103,10 +112,23 @@ def decoder(cell, inputs, mask, initial_state, attention_states,
         if mapped_states is None:
             mapped_states = attention(None, attention_states, None, None,
                                       att_size)
-        seq = [inputs, mask]
+        # attention variables are created before cell variables to keep
+        # the order of variables in checkpoints
+        with ops.variable_scope("attention"):
+            with ops.variable_scope("query_w"):
+                ops.get_variable("matrix_0", [output_size, attn_size])
+            with ops.variable_scope("attention_v"):
+                ops.get_variable("matrix_0", [attn_size, 1])
+        # projections of target inputs are computed before scan
+        variables = cell.get_variables()
+        seq = cell.project(inputs, variables) + [mask]
         outputs_info = [initial_state, None]
         non_seq = [attention_states, attention_mask, mapped_states]
-        (states, contexts) = ops.scan(loop_fn, seq, outputs_info, non_seq)
+
+        # attention variables already exist
+        with ops.variable_scope(ops.get_variable_scope(), reuse=True):
+            outputs = ops.scan(loop_fn, seq, outputs_info, non_seq)
+            (states, contexts) = outputs
 
     return states, contexts
 
@@ -145,18 +167,55 @@ class rnnsearch:
         if "keep_prob" not in option:
             option["keep_prob"] = 1.0
 
+        if "sampled_softmax" not in option:
+            option["sampled_softmax"] = None
+
+        if "cell" not in option or option["cell"] is None:
+            option["cell"] = "gru"
+
+        if "cache" not in option:
+            option["cache"] = None
+
         dtype = theano.config.floatX
         scope = option["scope"]
         criterion = option["criterion"]
         initializer = option["initializer"]
         regularizer = option["regularizer"]
         keep_prob = option["keep_prob"] or 1.0
+        sampled_softmax = option["sampled_softmax"]
+
+        if option["cell"] == "gru":
+            gru_cell = nn.rnn_cell.gru_cell
+        elif option["cell"] == "fused_gru":
+            gru_cell = nn.rnn_cell.fused_gru_cell
+        else:
+            raise ValueError("unknown cell %s" % option["cell"])
+
+        # compiled functions are stored in this directory and reused by
+        # models with the same architecture
+        if option["cache"]:
+            keys = ["scope", "embdim", "hidden", "maxhid", "maxpart",
+                    "deephid", "cell", "criterion", "keep_prob",
+                    "sampled_softmax", "l1_scale", "l2_scale", "bosid",
+                    "eosid"]
+            key = [(k, option.get(k)) for k in keys]
+            key += [("vocabsize", [svsize, tvsize]), ("dtype", dtype)]
+            cache = ops.function_cache(option["cache"], repr(key))
+        else:
+            cache = None
+
+        def function(name, inputs, outputs, **kwargs):
+            return ops.lazy_function(inputs, outputs, cache=cache,
+                                     name=name, **kwargs)
 
         # MRT mode do not use dropout
         if criterion == "mrt":
             keep_prob = 1.0
+            sampled_softmax = None
 
-        def prediction(prev_inputs, prev_state, context, keep_prob=1.0):
+        # candidates: if provided, only compute logits of these words
+        def prediction(prev_inputs, prev_state, context, keep_prob=1.0,
+                       candidates=None):
             features = [prev_state, prev_inputs, context]
             maxhid = nn.maxout(features, [[thdim, tedim, 2 * shdim], maxdim],
                                maxpart, True)
@@ -166,16 +225,25 @@ class rnnsearch:
             if keep_prob < 1.0:
                 readout = nn.dropout(readout, keep_prob=keep_prob)
 
-            logits = nn.linear(readout, [deephid, tvsize], True,
-                               scope="logits")
+            if candidates is None:
+                logits = nn.linear(readout, [deephid, tvsize], True,
+                                   scope="logits")
+            else:
+                # select rows of the output layer, variables are created by
+                # nn.linear in the training graph
+                with ops.variable_scope("logits"):
+                    matrix = ops.get_variable("matrix_0", [deephid, tvsize])
+                    bias = ops.get_variable("bias", [tvsize])
+
+                matrix = matrix[:, candidates]
+                bias = bias[candidates]
+                logits = theano.dot(readout, matrix) + bias
 
             if logits.ndim == 3:
                 new_shape = [logits.shape[0] * logits.shape[1], -1]
                 logits = logits.reshape(new_shape)
 
-            probs = theano.tensor.nnet.softmax(logits)
-
-            return probs
+            return logits
 
         # training graph
         with ops.variable_scope(scope, initializer=initializer,
@@ -189,6 +257,15 @@ class rnnsearch:
                 loss = theano.tensor.vector("loss_score")
                 sharp = theano.tensor.scalar("sharpness")
 
+            if sampled_softmax:
+                # normalize over a subset of the target vocabulary, built
+                # from gold words and sampled words for each batch
+                tgt_candidates = theano.tensor.ivector("target_candidates")
+                # position of target words in tgt_candidates
+                tgt_index = theano.tensor.imatrix("target_candidate_index")
+                # log probabilities of including each candidate
+                tgt_correction = theano.tensor.vector("candidate_correction")
+
             with ops.variable_scope("source_embedding"):
                 source_embedding = ops.get_variable("embedding",
                                                     [svsize, sedim])
@@ -209,7 +286,7 @@ class rnnsearch:
                 source_inputs = nn.dropout(source_inputs, keep_prob=keep_prob)
                 target_inputs = nn.dropout(target_inputs, keep_prob=keep_prob)
 
-            cell = nn.rnn_cell.gru_cell([sedim, shdim])
+            cell = gru_cell([sedim, shdim])
 
             outputs = encoder(cell, source_inputs, src_mask)
             annotation = theano.tensor.concatenate(outputs, 2)
@@ -225,7 +302,7 @@ class rnnsearch:
                                                activation=theano.tensor.tanh)
 
             # run decoder
-            cell = nn.rnn_cell.gru_cell([[tedim, 2 * shdim], thdim])
+            cell = gru_cell([[tedim, 2 * shdim], thdim])
 
             if criterion == "mrt":
                 # In MRT training, shape of src_seq and src_mask are assumed
@@ -261,12 +338,23 @@ class rnnsearch:
             prev_states = all_states[:-1]
 
             with ops.variable_scope("decoder"):
-                probs = prediction(shift_inputs, prev_states, all_context,
-                                   keep_prob=keep_prob)
+                if sampled_softmax:
+                    logits = prediction(shift_inputs, prev_states, all_context,
+                                        keep_prob=keep_prob,
+                                        candidates=tgt_candidates)
+                    logits = logits - tgt_correction
+                    labels = tgt_index.flatten()
+                else:
+                    logits = prediction(shift_inputs, prev_states, all_context,
+                                        keep_prob=keep_prob)
+                    labels = tgt_seq.flatten()
+
+                # normalized probabilities are never stored separately
+                log_probs = theano.tensor.nnet.logsoftmax(logits)
 
             # compute cost
-            idx = theano.tensor.arange(tgt_seq.flatten().shape[0])
-            ce = -theano.tensor.log(probs[idx, tgt_seq.flatten()])
+            idx = theano.tensor.arange(labels.shape[0])
+            ce = -log_probs[idx, labels]
             ce = ce.reshape(tgt_seq.shape)
             ce = theano.tensor.sum(ce * tgt_mask, 0)
 
@@ -283,7 +371,10 @@ class rnnsearch:
                 risk = theano.tensor.sum(qprob * loss)
                 cost = risk
 
-        if criterion == "mle":
+        if criterion == "mle" and sampled_softmax:
+            training_inputs = [src_seq, src_mask, tgt_seq, tgt_mask,
+                               tgt_candidates, tgt_index, tgt_correction]
+        elif criterion == "mle":
             training_inputs = [src_seq, src_mask, tgt_seq, tgt_mask]
         else:
             training_inputs = [src_seq, src_mask, tgt_seq, tgt_mask, loss,
@@ -293,6 +384,16 @@ class rnnsearch:
         # decoding graph
         with ops.variable_scope(scope, reuse=True):
             prev_words = theano.tensor.ivector("prev_words")
+            # source sentence of each hypothesis
+            indices = theano.tensor.ivector("indices")
+            # number of words kept for each hypothesis in top-k mode
+            topk_size = theano.tensor.iscalar("topk")
+            # target words considered in shortlist mode
+            candidates = theano.tensor.ivector("candidates")
+            # used in the fused step, hypotheses selected by beam pruning
+            pointers = theano.tensor.ivector("pointers")
+            prev_state = theano.tensor.matrix("prev_state")
+            prev_context = theano.tensor.matrix("prev_context")
 
             # disable dropout
             source_inputs = nn.embedding_lookup(source_embedding, src_seq)
@@ -300,7 +401,7 @@ class rnnsearch:
             target_inputs = nn.embedding_lookup(target_embedding, tgt_seq)
             target_inputs = target_inputs + target_bias
 
-            cell = nn.rnn_cell.gru_cell([sedim, shdim])
+            cell = gru_cell([sedim, shdim])
             outputs = encoder(cell, source_inputs, src_mask)
             annotation = theano.tensor.concatenate(outputs, 2)
 
@@ -318,7 +419,7 @@ class rnnsearch:
             # zeros out embedding if y is 0
             inputs = inputs * cond[:, None]
 
-            cell = nn.rnn_cell.gru_cell([[tedim, 2 * shdim], thdim])
+            cell = gru_cell([[tedim, 2 * shdim], thdim])
 
             # encode -> prediction -> generation
             # prediction: prev_word + prev_state => context, next_word
@@ -328,27 +429,84 @@ class rnnsearch:
                 # used in encoding
                 mapped_states = attention(None, annotation, None, None,
                                           [thdim, 2 * shdim, ahdim])
-                # used in prediction
-                alpha = attention(initial_state, None, mapped_states, src_mask,
-                                  [thdim, 2 * shdim, ahdim])
-                context = theano.tensor.sum(alpha[:, :, None] * annotation, 0)
-                probs = prediction(inputs, initial_state, context)
+                # used in prediction, annotations are selected in the graph
+                # instead of being repeated for every hypothesis
+                b_annotation = annotation[:, indices]
+                b_mapped_states = mapped_states[:, indices]
+                b_src_mask = src_mask[:, indices]
+                alpha = attention(initial_state, None, b_mapped_states,
+                                  b_src_mask, [thdim, 2 * shdim, ahdim])
+                context = theano.tensor.sum(alpha[:, :, None] * b_annotation,
+                                            0)
+                logits = prediction(inputs, initial_state, context)
+                log_probs = theano.tensor.nnet.logsoftmax(logits)
+                logits = prediction(inputs, initial_state, context,
+                                    candidates=candidates)
+                short_log_probs = theano.tensor.nnet.logsoftmax(logits)
                 # used in generation
                 output, next_state = cell([inputs, context], initial_state)
-
+                # fused step: selection -> generation -> prediction
+                step_state = prev_state[pointers]
+                step_context = prev_context[pointers]
+                output, step_state = cell([inputs, step_context], step_state)
+                step_alpha = attention(step_state, None, b_mapped_states,
+                                       b_src_mask, [thdim, 2 * shdim, ahdim])
+                step_context = step_alpha[:, :, None] * b_annotation
+                step_context = theano.tensor.sum(step_context, 0)
+                logits = prediction(inputs, step_state, step_context)
+                step_log_probs = theano.tensor.nnet.logsoftmax(logits)
+                logits = prediction(inputs, step_state, step_context,
+                                    candidates=candidates)
+                step_short_log_probs = theano.tensor.nnet.logsoftmax(logits)
+
+            # top-k mode: only the k best words and the eos score are
+            # returned for each hypothesis
+            eosid = option["eosid"]
+            outputs = theano.tensor.topk_and_argtopk(log_probs, topk_size,
+                                                     sorted=False)
+            topk_outputs = list(outputs) + [log_probs[:, eosid]]
+            outputs = theano.tensor.topk_and_argtopk(step_log_probs,
+                                                     topk_size, sorted=False)
+            step_topk_outputs = list(outputs) + [step_log_probs[:, eosid]]
+
+        # all functions below are compiled on first call, see compile
         # encoding
         encoding_inputs = [src_seq, src_mask]
         encoding_outputs = [annotation, initial_state, mapped_states]
-        encode = theano.function(encoding_inputs, encoding_outputs)
+        encode = function("encode", encoding_inputs, encoding_outputs)
 
         prediction_inputs = [prev_words, initial_state, annotation,
-                             mapped_states, src_mask]
-        prediction_outputs = [probs, context, alpha]
-        predict = theano.function(prediction_inputs, prediction_outputs)
+                             mapped_states, src_mask, indices]
+        prediction_outputs = [log_probs, context, alpha]
+        predict = function("predict", prediction_inputs, prediction_outputs)
+
+        topk_inputs = prediction_inputs + [topk_size]
+        topk_outputs = topk_outputs + [context, alpha]
+        predict_topk = function("predict_topk", topk_inputs, topk_outputs)
+
+        # log probabilities over candidates only
+        shortlist_inputs = prediction_inputs + [candidates]
+        shortlist_outputs = [short_log_probs, context, alpha]
+        predict_shortlist = function("predict_shortlist", shortlist_inputs,
+                                     shortlist_outputs)
 
         generation_inputs = [prev_words, initial_state, context]
         generation_outputs = next_state
-        generate = theano.function(generation_inputs, generation_outputs)
+        generate = function("generate", generation_inputs, generation_outputs)
+
+        step_inputs = [prev_words, pointers, prev_state, prev_context,
+                       annotation, mapped_states, src_mask, indices]
+        step_outputs = [step_log_probs, step_context, step_alpha, step_state]
+        step = function("step", step_inputs, step_outputs)
+
+        topk_inputs = step_inputs + [topk_size]
+        topk_outputs = step_topk_outputs + step_outputs[1:]
+        step_topk = function("step_topk", topk_inputs, topk_outputs)
+
+        shortlist_inputs = step_inputs + [candidates]
+        shortlist_outputs = [step_short_log_probs] + step_outputs[1:]
+        step_shortlist = function("step_shortlist", shortlist_inputs,
+                                  shortlist_outputs)
 
         # sampling graph, this feature is optional
         with ops.variable_scope(scope, reuse=True):
@@ -358,7 +516,8 @@ class rnnsearch:
                 alpha = attention(state, None, m_states, attn_mask,
                                   [thdim, 2 * shdim, ahdim])
                 context = theano.tensor.sum(alpha[:, :, None] * attn_states, 0)
-                probs = prediction(inputs, state, context)
+                logits = prediction(inputs, state, context)
+                probs = theano.tensor.nnet.softmax(logits)
                 next_words = ops.random.multinomial(probs).argmax(axis=1)
                 new_inputs = nn.embedding_lookup(target_embedding, next_words)
                 new_inputs = new_inputs + target_bias
@@ -379,8 +538,8 @@ class rnnsearch:
 
         sampling_inputs = [src_seq, src_mask, max_len]
         sampling_outputs = sampled_words
-        sample = theano.function(sampling_inputs, sampling_outputs,
-                                 updates=updates)
+        sample = function("sample", sampling_inputs, sampling_outputs,
+                          updates=updates)
 
         # attention graph, this feature is optional
         with ops.variable_scope(scope, reuse=True):
@@ -405,7 +564,7 @@ class rnnsearch:
 
         alignment_inputs = [src_seq, src_mask, tgt_seq, tgt_mask]
         alignment_outputs = attention_score
-        align = theano.function(alignment_inputs, alignment_outputs)
+        align = function("align", alignment_inputs, alignment_outputs)
 
         self.cost = cost
         self.inputs = training_inputs
@@ -416,140 +575,232 @@ class rnnsearch:
         self.encode = encode
         self.predict = predict
         self.generate = generate
+        self.step = step
+        self.predict_topk = predict_topk
+        self.step_topk = step_topk
+        self.predict_shortlist = predict_shortlist
+        self.step_shortlist = step_shortlist
+        self.cache = cache
         self.option = option
 
+    # functions are compiled on first use, this compiles the given functions
+    # in advance, e.g. model.compile("encode", "predict", "step")
+    def compile(self, *names):
+        for name in names:
+            getattr(self, name).compile()
+
 
-# TODO: add batched decoding
 def beamsearch(models, seq, mask=None, beamsize=10, normalize=False,
-               maxlen=None, minlen=None, arithmetic=False, dtype=None):
-    size = beamsize
+               maxlen=None, minlen=None, arithmetic=False, topk=False,
+               candidates=None, dtype=None):
+    outputs = batched_beamsearch(models, seq, mask, beamsize, normalize,
+                                 maxlen, minlen, arithmetic, topk, candidates,
+                                 dtype)
+
+    return outputs[0]
+
+
+# seq: a padded [len, batch] source matrix, one beam is kept per sentence
+# returns a list of nbest lists, one for each sentence in the batch
+# topk: only fetch the best beamsize + 1 words of each hypothesis from the
+# model, ensembles always need full distributions
+# candidates: target words shared by the batch, output layer is restricted
+# to these words, must contain eos
+def batched_beamsearch(models, seq, mask=None, beamsize=10, normalize=False,
+                       maxlen=None, minlen=None, arithmetic=False, topk=False,
+                       candidates=None, dtype=None):
     dtype = dtype or theano.config.floatX
 
     if not isinstance(models, (list, tuple)):
         models = [models]
 
     num_models = len(models)
+    batch = seq.shape[1]
+    topk = topk and num_models == 1 and candidates is None
 
     # get vocabulary from the first model
     vocab = models[0].option["vocabulary"][1][1]
     eosid = models[0].option["eosid"]
     bosid = models[0].option["bosid"]
 
-    if maxlen == None:
-        maxlen = seq.shape[0] * 3
-
-    if minlen == None:
-        minlen = seq.shape[0] / 2
-
     # encoding source
     if mask is None:
         mask = numpy.ones(seq.shape, dtype)
 
+    # length limits are computed for each sentence
+    lengths = mask.sum(0).astype("int32")
+
+    if maxlen == None:
+        maxlens = lengths * 3
+    else:
+        maxlens = numpy.array([maxlen] * batch, "int32")
+
+    if minlen == None:
+        minlens = lengths / 2
+    else:
+        minlens = numpy.array([minlen] * batch, "int32")
+
     outputs = [model.encode(seq, mask) for model in models]
     annotations = [item[0] for item in outputs]
     states = [item[1] for item in outputs]
     mapped_annots = [item[2] for item in outputs]
 
-    initial_beam = beam(size)
     # bosid must be 0
-    initial_beam.candidate = [[bosid]]
-    initial_beam.score = numpy.zeros([1], dtype)
-
-    hypo_list = []
-    beam_list = [initial_beam]
-    cond = lambda x: x[-1] == eosid
-
-    for k in range(maxlen):
-        # get previous results
-        prev_beam = beam_list[-1]
-        candidate = prev_beam.candidate
-        num = len(candidate)
-        last_words = numpy.array(map(lambda t: t[-1], candidate), "int32")
-
-        # compute context first, then compute word distribution
-        batch_mask = numpy.repeat(mask, num, 1)
-        batch_annots = map(numpy.repeat, annotations, [num] * num_models,
-                           [1] * num_models)
-        batch_mannots = map(numpy.repeat, mapped_annots, [num] * num_models,
-                           [1] * num_models)
-
-        # predict returns [probs, context, alpha]
-        outputs = [model.predict(last_words, state, annot, mannot, batch_mask)
-                                 for model, state, annot, mannot in
-                                 zip(models, states, batch_annots,
-                                     batch_mannots)]
-        prob_dists = [item[0] for item in outputs]
-        contexts = [item[1] for item in outputs]
+    beams = [beam(beamsize, maxlens[i], bosid, dtype=dtype)
+             for i in range(batch)]
+    hypo_lists = [[] for i in range(batch)]
+
+    # sentences still being decoded, and the source sentence of each row
+    active = [i for i in range(batch) if maxlens[i] > 0]
+    sent_indices = numpy.array(active, "int32")
+    states = select_nbest(states, sent_indices)
+    last_words = numpy.zeros([len(active)], "int32") + bosid
+    k = 0
+
+    # top-k functions return [values, word_indices, eos_log_probs] instead
+    # of the full log_probs, followed by the same outputs
+    if topk:
+        predict = [model.predict_topk for model in models]
+        step = [model.step_topk for model in models]
+        extra_inputs = [min(beamsize + 1, len(vocab))]
+        n = 2
+    elif candidates is not None:
+        predict = [model.predict_shortlist for model in models]
+        step = [model.step_shortlist for model in models]
+        candidates = numpy.asarray(candidates, "int32")
+        extra_inputs = [candidates]
+        n = 0
+    else:
+        predict = [model.predict for model in models]
+        step = [model.step for model in models]
+        extra_inputs = []
+        n = 0
+
+    # column of eos in distributions
+    if candidates is not None:
+        eos_column = int(numpy.nonzero(candidates == eosid)[0][0])
+    else:
+        eos_column = eosid
+
+    # compute context first, then compute word distribution
+    # predict returns [log_probs, context, alpha]
+    outputs = [fn(last_words, state, annot, mannot, mask, sent_indices,
+                  *extra_inputs)
+               for fn, state, annot, mannot in
+               zip(predict, states, annotations, mapped_annots)]
+
+    while active:
+        log_dists = [item[0] for item in outputs]
+        contexts = [item[1 + n] for item in outputs]
 
         # search nbest given word distribution
-        if arithmetic:
-            logprobs = numpy.log(sum(prob_dists) / num_models)
+        if topk:
+            logprobs, word_indices, eos_logprobs = outputs[0][:3]
+        elif num_models == 1:
+            logprobs = log_dists[0]
+        elif arithmetic:
+            probs = sum([numpy.exp(item) for item in log_dists])
+            logprobs = numpy.log(probs / num_models)
         else:
             # geometric mean
-            logprobs = sum(numpy.log(prob_dists)) / num_models
+            logprobs = sum(log_dists) / num_models
 
-        if k < minlen:
-            logprobs[:, eosid] = -numpy.inf
+        next_active = []
+        batch_indices = []
+        offset = 0
 
-        # force to add eos symbol
-        if k == maxlen - 1:
-            # copy
-            eosprob = logprobs[:, eosid].copy()
-            logprobs[:, :] = -numpy.inf
-            logprobs[:, eosid] = eosprob
+        for i in active:
+            num = len(beams[i])
+            dist = logprobs[offset:offset + num]
+            indices = candidates
 
-        next_beam = beam(size)
-        outputs = next_beam.prune(logprobs, cond, prev_beam)
+            if topk:
+                indices = word_indices[offset:offset + num]
 
-        # translation complete
-        hypo_list.extend(outputs[0])
-        batch_indices, word_indices = outputs[1:]
-        size -= len(outputs[0])
+                if k < minlens[i]:
+                    dist[indices == eosid] = -numpy.inf
 
-        if size == 0:
+                # force to add eos symbol
+                if k == maxlens[i] - 1:
+                    dist = eos_logprobs[offset:offset + num, None]
+                    indices = numpy.zeros(dist.shape, "int32") + eosid
+            else:
+                if k < minlens[i]:
+                    dist[:, eos_column] = -numpy.inf
+
+                # force to add eos symbol
+                if k == maxlens[i] - 1:
+                    # copy
+                    eosprob = dist[:, eos_column].copy()
+                    dist[:, :] = -numpy.inf
+                    dist[:, eos_column] = eosprob
+
+            outputs = beams[i].prune(dist, eosid, indices)
+
+            # translation complete
+            hypo_lists[i].extend(outputs[0])
+
+            if beams[i].size > 0 and k < maxlens[i] - 1:
+                next_active.append(i)
+                batch_indices.append(outputs[1] + offset)
+
+            offset += num
+
+        active = next_active
+
+        if not active:
             break
 
-        # generate next state
-        candidate = next_beam.candidate
-        num = len(candidate)
-        last_words = numpy.array(map(lambda t: t[-1], candidate), "int32")
+        # pack hypotheses of all active sentences
+        batch_indices = numpy.concatenate(batch_indices).astype("int32")
+        sent_indices = sent_indices[batch_indices]
+        last_words = [beams[i].last_words for i in active]
+        last_words = numpy.concatenate(last_words)
 
-        states = select_nbest(states, batch_indices)
-        contexts = select_nbest(contexts, batch_indices)
+        # select hypotheses, generate next state and compute word
+        # distribution in one call
+        # step returns [log_probs, context, alpha, state]
+        outputs = [fn(last_words, batch_indices, state, context, annot,
+                      mannot, mask, sent_indices, *extra_inputs)
+                   for fn, state, context, annot, mannot in
+                   zip(step, states, contexts, annotations, mapped_annots)]
+        states = [item[3 + n] for item in outputs]
 
-        states = [model.generate(last_words, state, context)
-                  for model, state, context in zip(models, states, contexts)]
+        k += 1
 
-        beam_list.append(next_beam)
+    results = []
 
     # postprocessing
-    if len(hypo_list) == 0:
-        score_list = [0.0]
-        hypo_list = [[eosid]]
-    else:
-        score_list = [item[1] for item in hypo_list]
-        # exclude bos symbol
-        hypo_list = [item[0][1:] for item in hypo_list]
-
-    for i, (trans, score) in enumerate(zip(hypo_list, score_list)):
-        count = len(trans)
-        if count > 0:
-            if normalize:
-                score_list[i] = score / count
-            else:
-                score_list[i] = score
+    for hypo_list in hypo_lists:
+        if len(hypo_list) == 0:
+            score_list = [0.0]
+            hypo_list = [[eosid]]
+        else:
+            score_list = [item[1] for item in hypo_list]
+            # exclude bos symbol
+            hypo_list = [item[0][1:] for item in hypo_list]
+
+        for i, (trans, score) in enumerate(zip(hypo_list, score_list)):
+            count = len(trans)
+            if count > 0:
+                if normalize:
+                    score_list[i] = score / count
+                else:
+                    score_list[i] = score
+
+        # sort
+        hypo_list = numpy.array(hypo_list)[numpy.argsort(score_list)]
+        score_list = numpy.array(sorted(score_list))
 
-    # sort
-    hypo_list = numpy.array(hypo_list)[numpy.argsort(score_list)]
-    score_list = numpy.array(sorted(score_list))
+        output = []
 
-    output = []
+        for trans, score in zip(hypo_list, score_list):
+            trans = map(lambda x: vocab[x], trans)
+            output.append((trans, score))
 
-    for trans, score in zip(hypo_list, score_list):
-        trans = map(lambda x: vocab[x], trans)
-        output.append((trans, score))
+        results.append(output)
 
-    return output
+    return results
 
 
 def batchsample(model, seq, mask, maxlen=None):
@@ -603,11 +854,12 @@ def evaluate_model(model, xseq, xmask, yseq, ymask, alignment=None,
 
     for i in range(t):
         outputs = model.predict(last_words, states, annotation, mapped_annot,
-                                xmask)
-        # probs: batch * vocab
+                                xmask, indices)
+        # log_probs: batch * vocab
         # contexts: batch * hdim
         # alpha: batch * srclen
-        probs, contexts, alpha = outputs
+        log_probs, contexts, alpha = outputs
+        probs = numpy.exp(log_probs)
 
         if alignment is not None:
             # alignment tgt * src * batch
@@ -637,7 +889,7 @@ def evaluate_model(model, xseq, xmask, yseq, ymask, alignment=None,
                     print "prob: %f vs %f, entropy: %f" % (pp, gp, ent)
                     print "gold is %d-th best" % (gold_order + 1)
 
-        costs -= numpy.log(probs[indices, label]) * mask
+        costs -= log_probs[indices, label] * mask
 
         last_words = label
         states = model.generate(last_words, states, contexts)
@@ -6,7 +6,7 @@ import theano
 
 from dropout import dropout
 from nn import linear, feedforward
-from ops import variable_scope
+from ops import variable_scope, get_variable
 
 
 class rnn_cell(object):
@@ -67,6 +67,181 @@ class gru_cell(rnn_cell):
 
         return new_state, new_state
 
+    # variables used by __call__, created in the same order
+    # returns [reset_matrices, update_matrices, candidate_matrices, bias]
+    def get_variables(self, scope=None):
+        output_size = self.output_size
+        size = list(self.input_size) + [output_size]
+        variables = []
+
+        with variable_scope(scope or "gru_cell"):
+            for name in ["reset_gate", "update_gate", "candidate"]:
+                with variable_scope(name):
+                    matrices = []
+                    for i, input_size in enumerate(size):
+                        shape = [input_size, output_size]
+                        matrices.append(get_variable("matrix_%d" % i, shape))
+                    variables.append(matrices)
+
+            with variable_scope("candidate"):
+                variables.append(get_variable("bias", [output_size]))
+
+        return variables
+
+    # input projections of the leading inputs, they do not depend on state
+    # and can be computed for a whole sequence outside of scan
+    # variables: outputs of get_variables
+    def project(self, inputs, variables):
+        if not isinstance(inputs, (list, tuple)):
+            inputs = [inputs]
+
+        if len(inputs) > len(self.input_size):
+            raise RuntimeError("unmatched elements: inputs and input_size")
+
+        projections = []
+
+        for matrices in variables[:3]:
+            results = [theano.dot(x, w) for x, w in zip(inputs, matrices)]
+            projections.append(reduce(theano.tensor.add, results))
+
+        projections[2] = projections[2] + variables[3]
+
+        return projections
+
+    # projections: outputs of project, inputs: the remaining inputs
+    def update(self, projections, inputs, state, variables):
+        if not isinstance(inputs, (list, tuple)):
+            inputs = [inputs]
+
+        n = len(self.input_size) - len(inputs)
+        reset_w, update_w, candidate_w, bias = variables
+        xr, xu, xc = projections
+
+        for x, wr, wu, wc in zip(inputs, reset_w[n:], update_w[n:],
+                                 candidate_w[n:]):
+            xr = xr + theano.dot(x, wr)
+            xu = xu + theano.dot(x, wu)
+            xc = xc + theano.dot(x, wc)
+
+        r = theano.tensor.nnet.sigmoid(xr + theano.dot(state, reset_w[-1]))
+        u = theano.tensor.nnet.sigmoid(xu + theano.dot(state, update_w[-1]))
+        c = theano.tensor.tanh(xc + theano.dot(r * state, candidate_w[-1]))
+
+        new_state = (1.0 - u) * state + u * c
+
+        return new_state
+
+    @property
+    def state_size(self):
+        return self._size[1]
+
+    @property
+    def input_size(self):
+        return self._size[0]
+
+    @property
+    def output_size(self):
+        return self._size[1]
+
+    def zero_state(self, batch_size, dtype=None):
+        output_size = self.output_size
+        return theano.tensor.zeros([batch_size, output_size], dtype=dtype)
+
+
+class fused_gru_cell(rnn_cell):
+
+    # same as gru_cell, but weights of all gates are stored in a single
+    # [sum(input_size) + output_size, 3 * output_size] matrix, columns are
+    # ordered as reset gate, update gate and candidate
+    def __init__(self, size):
+        if not isinstance(size, (list, tuple)):
+            raise ValueError("size argument must be [input_size, output_size]")
+
+        input_size, output_size = size
+
+        if not isinstance(input_size, (list, tuple)):
+            input_size = [input_size]
+
+        self._size = (tuple(input_size), output_size)
+
+    def __call__(self, inputs, state, scope=None):
+        if not isinstance(inputs, (list, tuple)):
+            inputs = [inputs]
+
+        if len(inputs) != len(self.input_size):
+            raise RuntimeError("unmatched elements: inputs and input_size")
+
+        variables = self.get_variables(scope)
+        projections = self.project(inputs, variables)
+        new_state = self.update(projections, [], state, variables)
+
+        return new_state, new_state
+
+    # returns [matrix, bias]
+    def get_variables(self, scope=None):
+        output_size = self.output_size
+        input_size = sum(self.input_size) + output_size
+
+        with variable_scope(scope or "fused_gru_cell"):
+            with variable_scope("gates"):
+                shape = [input_size, 3 * output_size]
+                matrix = get_variable("matrix", shape)
+                bias = get_variable("bias", [3 * output_size])
+
+        return [matrix, bias]
+
+    # rows of the matrix used by each input, the last one is state
+    def _split(self, matrix):
+        offset = 0
+        matrices = []
+
+        for input_size in self.input_size:
+            matrices.append(matrix[offset:offset + input_size])
+            offset += input_size
+
+        matrices.append(matrix[offset:])
+
+        return matrices
+
+    # one GEMM for each input, computing all gates at once
+    def project(self, inputs, variables):
+        if not isinstance(inputs, (list, tuple)):
+            inputs = [inputs]
+
+        if len(inputs) > len(self.input_size):
+            raise RuntimeError("unmatched elements: inputs and input_size")
+
+        matrix, bias = variables
+        matrices = self._split(matrix)
+        results = [theano.dot(x, w) for x, w in zip(inputs, matrices)]
+        results.append(bias)
+
+        return [reduce(theano.tensor.add, results)]
+
+    def update(self, projections, inputs, state, variables):
+        if not isinstance(inputs, (list, tuple)):
+            inputs = [inputs]
+
+        n = len(self.input_size) - len(inputs)
+        size = self.output_size
+        matrices = self._split(variables[0])
+        x = projections[0]
+
+        for item, w in zip(inputs, matrices[n:-1]):
+            x = x + theano.dot(item, w)
+
+        # reset and update gates share a GEMM, candidate needs r * state
+        w = matrices[-1]
+        h = theano.dot(state, w[:, :2 * size])
+        r = theano.tensor.nnet.sigmoid(x[:, :size] + h[:, :size])
+        u = theano.tensor.nnet.sigmoid(x[:, size:2 * size] + h[:, size:])
+        c = x[:, 2 * size:] + theano.dot(r * state, w[:, 2 * size:])
+        c = theano.tensor.tanh(c)
+
+        new_state = (1.0 - u) * state + u * c
+
+        return new_state
+
     @property
     def state_size(self):
         return self._size[1]
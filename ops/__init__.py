@@ -4,9 +4,12 @@
 
 import random
 
-from function import function
+from cache import function_cache
+from function import function, lazy_function
 from scan import scan, get_updates, merge_updates
 from variable import variable, global_variables, trainable_variables
+from variable import variable_shape, deferred_initialization
+from variable import initialize_variables
 from variable_scope import variable_scope, get_variable_scope, get_variable
 from initializer import zeros_initializer, ones_initializer
 from initializer import constant_initializer, random_uniform_initializer
@@ -19,12 +22,17 @@ from regularizer import apply_regularization, get_regularization_loss
 __all__ = [
     "random",
     "function",
+    "lazy_function",
+    "function_cache",
     "scan",
     "get_updates",
     "merge_updates",
     "variable",
     "global_variables",
     "trainable_variables",
+    "variable_shape",
+    "deferred_initialization",
+    "initialize_variables",
     "variable_scope",
     "get_variable_scope",
     "get_variable",
@@ -0,0 +1,184 @@
+# cache.py
+# persistent on-disk cache of compiled Theano functions
+# author: Playinf
+# email: playinf@stu.xmu.edu.cn
+
+import os
+import sys
+import errno
+import numpy
+import theano
+import cPickle
+import hashlib
+import tempfile
+
+from theano.compile.pfunc import rebuild_collect_shared
+
+
+__all__ = ["function_cache"]
+
+
+_CODE_VERSION = []
+# pickling deep graphs needs a large recursion limit
+_RECURSION_LIMIT = 50000
+
+
+# hash of all source files, graphs change with code
+def code_version():
+    if _CODE_VERSION:
+        return _CODE_VERSION[0]
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    md5 = hashlib.md5()
+
+    for dirname, dirnames, filenames in sorted(os.walk(root)):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if not filename.endswith(".py"):
+                continue
+            fd = open(os.path.join(dirname, filename), "rb")
+            md5.update(fd.read())
+            fd.close()
+
+    _CODE_VERSION.append(md5.hexdigest())
+
+    return _CODE_VERSION[0]
+
+
+def theano_flags():
+    config = theano.config
+    flags = [theano.__version__, config.floatX, config.device, config.mode,
+             config.optimizer, config.optimizer_including,
+             config.optimizer_excluding, config.cxx, config.blas.ldflags]
+
+    return repr(flags)
+
+
+# shared variables of a function, in the order used by theano.function
+def shared_inputs(inputs, outputs, updates=None):
+    if updates is None:
+        updates = []
+
+    outputs = rebuild_collect_shared(outputs, inputs, updates=updates,
+                                     rebuild_strict=True,
+                                     copy_inputs_over=True)
+
+    return outputs[2][3]
+
+
+class function_cache(object):
+
+    # directory: where compiled functions are stored
+    # key: a string identifying the graphs, e.g. model options
+    def __init__(self, directory, key):
+        key = "\n".join([key, theano_flags(), code_version()])
+        self._directory = directory
+        self._key = key
+        self._hash = hashlib.md5(key).hexdigest()
+
+    @property
+    def key(self):
+        return self._key
+
+    # a new cache for graphs built on top of this one
+    def extend(self, key):
+        return function_cache(self._directory, self._key + "\n" + key)
+
+    def _filename(self, name):
+        filename = "%s.%s.pkl" % (name, self._hash)
+        return os.path.join(self._directory, filename)
+
+    # same as theano.function, but compiled functions are loaded from disk if
+    # possible, only the graph optimizer output is stored, parameters are
+    # bound to shared variables of the current process
+    def function(self, name, inputs, outputs, updates=None, **kwargs):
+        filename = self._filename(name)
+        variables = shared_inputs(inputs, outputs, updates)
+
+        if os.path.exists(filename):
+            fn = self._load(filename, variables)
+            if fn is not None:
+                return fn
+
+        fn = theano.function(inputs, outputs, updates=updates, **kwargs)
+        self._save(filename, fn)
+
+        return fn
+
+    def _load(self, filename, variables):
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(limit, _RECURSION_LIMIT))
+
+        try:
+            fd = open(filename, "rb")
+            maker = cPickle.load(fd)
+            fd.close()
+        except Exception:
+            return None
+        finally:
+            sys.setrecursionlimit(limit)
+
+        storage = []
+        implicit = [item for item in maker.inputs if item.implicit]
+
+        if len(implicit) != len(variables):
+            return None
+
+        variables = iter(variables)
+
+        for item in maker.inputs:
+            if not item.implicit:
+                storage.append(item.value)
+                continue
+
+            var = variables.next()
+
+            if var.type != item.variable.type:
+                return None
+
+            storage.append(var.container)
+
+        return maker.create(storage)
+
+    def _save(self, filename, fn):
+        # values of shared variables are not stored
+        variables = [item.variable for item in fn.maker.inputs
+                     if item.implicit and hasattr(item.variable, "ndim")]
+        values = [var.get_value(borrow=True) for var in variables]
+        limit = sys.getrecursionlimit()
+        fd = None
+        tmpname = None
+
+        # the function is still usable if it can not be stored
+        try:
+            for var in variables:
+                var.set_value(numpy.zeros([0] * var.ndim, var.dtype),
+                              borrow=True)
+
+            sys.setrecursionlimit(max(limit, _RECURSION_LIMIT))
+
+            # another process may create the directory at the same time
+            try:
+                os.makedirs(self._directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+            fd, tmpname = tempfile.mkstemp(dir=self._directory)
+            fd = os.fdopen(fd, "wb")
+            cPickle.dump(fn.maker, fd, cPickle.HIGHEST_PROTOCOL)
+            fd.close()
+            os.rename(tmpname, filename)
+        except Exception as e:
+            # fd is still a descriptor if os.fdopen failed
+            if isinstance(fd, int):
+                os.close(fd)
+            elif fd is not None:
+                fd.close()
+            if tmpname and os.path.exists(tmpname):
+                os.remove(tmpname)
+            sys.stderr.write("cannot cache %s: %s\n" % (filename, e))
+        finally:
+            sys.setrecursionlimit(limit)
+            for var, val in zip(variables, values):
+                var.set_value(val, borrow=True)
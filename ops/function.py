@@ -33,3 +33,44 @@ def function(inputs, outputs, use_extension=True, **kwargs):
         return utils.pack_sequence_as(nest_outputs, outputs)
 
     return wrapper
+
+
+# compile a Theano function on its first call
+# cache: an optional function_cache, the function is stored under name
+class lazy_function(object):
+
+    def __init__(self, inputs, outputs, cache=None, name=None, **kwargs):
+        if cache is not None and name is None:
+            raise ValueError("name is required when cache is used")
+
+        self._inputs = inputs
+        self._outputs = outputs
+        self._kwargs = kwargs
+        self._cache = cache
+        self._name = name
+        self._function = None
+
+    def __call__(self, *args):
+        return self.compile()(*args)
+
+    @property
+    def compiled(self):
+        return self._function is not None
+
+    def compile(self):
+        if self._function is not None:
+            return self._function
+
+        if self._cache is not None:
+            fn = self._cache.function(self._name, self._inputs,
+                                      self._outputs, **self._kwargs)
+        else:
+            fn = theano.function(self._inputs, self._outputs, **self._kwargs)
+
+        self._function = fn
+        # release the graph
+        self._inputs = None
+        self._outputs = None
+        self._kwargs = None
+
+        return fn
@@ -30,3 +30,8 @@ def multinomial(dist, num_samples=1, seed=None):
 
     _RANDOM_STREAM.seed(seed)
     return _RANDOM_STREAM.multinomial(n=num_samples, pvals=dist)
+
+
+# reseeds every random stream created so far, used by forked processes
+def seed(seed):
+    _RANDOM_STREAM.seed(seed)
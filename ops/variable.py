@@ -3,36 +3,66 @@
 # author: Playinf
 # email: playinf@stu.xmu.edu.cn
 
+import numpy
 import theano
+import contextlib
 
 from collection import add_to_collection, get_collection
 
 __all__ = [
     "variable",
     "global_variables",
-    "trainable_variables"
+    "trainable_variables",
+    "variable_shape",
+    "deferred_initialization",
+    "initialize_variables"
 ]
 
 
 _GLOBAL_VARIABLES_KEY = "variables"
 _TRAINABLE_VARIABLES_KEY = "trainable_variables"
+_DEFERRED_INITIALIZATION = [False]
+
+
+# variables created in this context are not initialized, their values are
+# expected to be assigned later, e.g. from a checkpoint
+@contextlib.contextmanager
+def deferred_initialization(enabled=True):
+    old = _DEFERRED_INITIALIZATION[0]
+    _DEFERRED_INITIALIZATION[0] = enabled
+
+    try:
+        yield
+    finally:
+        _DEFERRED_INITIALIZATION[0] = old
 
 
 # a wrapper for theano.shared
+# shape: required to defer the initialization
 def variable(initial_value=None, trainable=True, name=None,
-             dtype=theano.config.floatX):
+             dtype=theano.config.floatX, shape=None):
     global _TRAINABLE_VARIABLES
     global _ALL_VARIABLES
 
     if initial_value is None:
         raise ValueError("initial_value must not be None")
 
-    if callable(initial_value):
+    initializer = None
+    deferred = _DEFERRED_INITIALIZATION[0] and shape is not None
+
+    if callable(initial_value) and deferred:
+        # an empty placeholder with the same type
+        val = numpy.zeros([0] * len(shape), dtype=dtype)
+        initializer = initial_value
+    elif callable(initial_value):
         val = initial_value()
     else:
         val = initial_value
 
     var = theano.shared(val, name=name, borrow=True)
+    # shape is known without reading the value
+    var.tag.shape = tuple(shape) if deferred else numpy.shape(val)
+    var.tag.initializer = initializer
 
     if trainable:
         add_to_collection(_TRAINABLE_VARIABLES_KEY, var)
@@ -48,3 +78,29 @@ def global_variables():
 
 def trainable_variables():
     return get_collection(_TRAINABLE_VARIABLES_KEY)
+
+
+def variable_shape(var):
+    if hasattr(var.tag, "shape"):
+        return var.tag.shape
+
+    return var.get_value(borrow=True, return_internal_type=True).shape
+
+
+# initialize deferred variables whose values are not assigned yet
+def initialize_variables(var_list=None):
+    if var_list is None:
+        var_list = global_variables()
+
+    for var in var_list:
+        initializer = getattr(var.tag, "initializer", None)
+
+        if initializer is None:
+            continue
+
+        value = var.get_value(borrow=True, return_internal_type=True)
+
+        if value.shape != var.tag.shape:
+            var.set_value(initializer(), borrow=True)
+
+        var.tag.initializer = None
@@ -7,7 +7,7 @@ import six
 import theano
 import contextlib
 
-from variable import variable
+from variable import variable, variable_shape
 from regularizer import add_regularization_loss
 from name_scope import name_scope as name_scope_op
 from dtype import is_integer_dtype, is_floating_dtype
@@ -75,7 +75,7 @@ class variable_store(object):
                                  name)
 
             found_var = self._vars[name]
-            found_shape = found_var.get_value().shape
+            found_shape = variable_shape(found_var)
 
             if not is_compatible_shape(shape, found_shape):
                 raise ValueError("trying to share variable %s, "
@@ -114,7 +114,7 @@ class variable_store(object):
 
         # create variable
         v = variable(initial_value=init_val, name=name, trainable=trainable,
-                     dtype=dtype)
+                     dtype=dtype, shape=shape)
 
         self._vars[name] = v
 
@@ -3,3 +3,4 @@
 # email: playinf@stu.xmu.edu.cn
 
 from optimizer import optimizer
+from parallel import data_parallel
@@ -4,14 +4,40 @@
 
 
 import ops
+import sys
 import numpy
 import theano
+import sparse
 import updates
 import constraint
 
 from collections import OrderedDict
 
 
+def apply_constraint(option, params, grads, indices):
+    gradsref = grads
+
+    if option["constraint"]:
+        method, value = option["constraint"]
+        if method == "value":
+            grads = constraint.clip_by_value(grads, value[0], value[1])
+        if method == "norm":
+            grads = constraint.clip_by_global_norm(grads, value)
+
+    if option["nanguard"]:
+        gnorm = constraint.global_norm(gradsref)
+        isnan = theano.tensor.isnan(gnorm)
+        isinf = theano.tensor.isinf(gnorm)
+        notfinite = theano.tensor.or_(isnan, isinf)
+        newgrads = []
+        for p, g, i in zip(params, grads, indices):
+            p = p if i is None else p[i]
+            newgrads.append(theano.tensor.switch(notfinite, 0.1 * p, g))
+        grads = newgrads
+
+    return grads
+
+
 class optimizer:
 
     def __init__(self, model, **option):
@@ -29,10 +55,68 @@ class optimizer:
         if regularization_loss:
             cost = cost + regularization_loss
 
-        grads = theano.grad(cost, params)
-        gradsref = grads
+        if "sparse" not in option:
+            option["sparse"] = False
+
+        # fused: gradients are applied in the same function, no buffers
+        if "fused" not in option:
+            option["fused"] = False
+
+        # number of batches whose gradients are summed before an update
+        if "accumulate" not in option:
+            option["accumulate"] = 1
+
+        nbatch = option["accumulate"]
+
+        if option["fused"] and nbatch > 1:
+            raise ValueError("fused updates can not accumulate gradients")
+
+        # parameters only used by lookups, e.g. embeddings, are updated
+        # row by row, gradients are taken with respect to the lookups
+        if option["sparse"]:
+            lookups = sparse.find_lookups(cost, params)
+        else:
+            lookups = {}
+
+        wrt = []
+
+        for p in params:
+            if p in lookups:
+                wrt.extend([item[0] for item in lookups[p]])
+            else:
+                wrt.append(p)
+
+        grads = iter(theano.grad(cost, wrt))
+        indices = []
+        newgrads = []
+
+        for p in params:
+            if p in lookups:
+                rowgrads = [grads.next() for item in lookups[p]]
+                index, grad = sparse.row_gradient(lookups[p], rowgrads)
+            else:
+                index, grad = None, grads.next()
+            indices.append(index)
+            newgrads.append(grad)
+
+        grads = newgrads
+
+        # gradient buffers, shared by optimize and update
+        vec = [None] * len(params)
+        # touched rows of sparse gradients
+        ivec = [None] * len(params)
+
+        for i, p in enumerate(params):
+            if option["fused"]:
+                continue
+
+            shape = list(ops.variable_shape(p))
+
+            if indices[i] is not None:
+                shape[0] = 0
+                ivec[i] = theano.shared(numpy.zeros([0], "int32"))
 
-        vec = [theano.shared(numpy.zeros_like(p.get_value())) for p in params]
+            vec[i] = theano.shared(numpy.zeros(shape, p.dtype))
 
         if "algorithm" not in option:
             option["algorithm"] = "sgd"
@@ -67,23 +151,6 @@ class optimizer:
             outputs = outputs[:]
             outputs.append(normval)
 
-        if option["constraint"]:
-            method, value = option["constraint"]
-            if method == "value":
-                grads = constraint.clip_by_value(grads, value[0], value[1])
-            if method == "norm":
-                grads = constraint.clip_by_global_norm(grads, value)
-
-        if option["nanguard"]:
-            gnorm = constraint.global_norm(gradsref)
-            isnan = theano.tensor.isnan(gnorm)
-            isinf = theano.tensor.isinf(gnorm)
-            notfinite = theano.tensor.or_(isnan, isinf)
-            newgrads = []
-            for p, g in zip(params, grads):
-                newgrads.append(theano.tensor.switch(notfinite, 0.1 * p, g))
-            grads = newgrads
-
         if option["nesterov"]:
             option["momentum"] = False
 
@@ -97,20 +164,61 @@ class optimizer:
         else:
             gup.extend(scan_updates)
 
-        for v, g in zip(vec, grads):
-            gup.append((v, g))
+        # outputs of update
+        uoutputs = []
+
+        if nbatch > 1:
+            # gradients are summed, the averaged gradient is constrained
+            # when updating
+            rgrads = []
+            rindices = []
+
+            for v, iv, g, i in zip(vec, ivec, grads, indices):
+                if iv is None:
+                    gup.append((v, v + g))
+                    rgrads.append(v / nbatch)
+                    rindices.append(None)
+                    continue
+
+                gup.append((v, theano.tensor.concatenate([v, g])))
+                gup.append((iv, theano.tensor.concatenate([iv, i])))
+                i, g = sparse.merge_rows(iv, v)
+                rgrads.append(g / nbatch)
+                rindices.append(i)
+
+            if option["norm"]:
+                uoutputs.append(constraint.global_norm(rgrads))
+
+            rgrads = apply_constraint(option, params, rgrads, rindices)
+        elif option["fused"]:
+            rgrads = apply_constraint(option, params, grads, indices)
+            rindices = indices
+        else:
+            grads = apply_constraint(option, params, grads, indices)
+
+            for v, g in zip(vec, grads):
+                gup.append((v, g))
+
+            for v, i in zip(ivec, indices):
+                if v is not None:
+                    gup.append((v, i))
+
+            rgrads = vec
+            rindices = ivec
 
         if algorithm == "sgd":
             alpha = theano.tensor.scalar()
             hparams = [alpha]
             defaults = [("alpha", 1.0)]
-            svar, pup = updates.sgd_updates(params, vec, *hparams)
+            svar, pup = updates.sgd_updates(params, rgrads, *hparams,
+                                            indices=rindices)
         elif algorithm == "adagrad":
             alpha = theano.tensor.scalar()
             epsilon = theano.tensor.scalar()
             hparams = [alpha, epsilon]
             defaults = [("alpha", 1.0), ("epsilon", 1e-6)]
-            svar, pup = updates.adagrad_updates(params, vec, *hparams)
+            svar, pup = updates.adagrad_updates(params, rgrads, *hparams,
+                                                indices=rindices)
         elif algorithm == "rmsprop":
             alpha = theano.tensor.scalar()
             rho = theano.tensor.scalar()
@@ -118,7 +226,8 @@ class optimizer:
             hparams = [alpha, rho, epsilon]
             defaults = [("alpha", 1e-2), ("rho", 0.99), ("epsilon", 1e-8)]
             rmsparam = hparams + variant
-            svar, pup = updates.rmsprop_updates(params, vec, *rmsparam)
+            svar, pup = updates.rmsprop_updates(params, rgrads, *rmsparam,
+                                                indices=rindices)
         elif algorithm == "rmsprop_momentum":
             alpha = theano.tensor.scalar()
             rho = theano.tensor.scalar()
@@ -127,14 +236,17 @@ class optimizer:
             hparams = [alpha, rho, epsilon, momentum]
             defaults = [("alpha", 1e-4), ("rho", 0.95), ("epsilon", 1e-4)]
             defaults.append(("moment", 0.9))
-            svar, pup = updates.rmsprop_momentum_updates(params, vec, *hparams)
+            svar, pup = updates.rmsprop_momentum_updates(params, rgrads,
+                                                         *hparams,
+                                                         indices=rindices)
         elif algorithm == "adadelta":
             alpha = theano.tensor.scalar()
             rho = theano.tensor.scalar()
             epsilon = theano.tensor.scalar()
             hparams = [alpha, rho, epsilon]
             defaults = [("alpha", 1.0), ("rho", 0.95), ("epsilon", 1e-6)]
-            svar, pup = updates.adadelta_updates(params, vec, *hparams)
+            svar, pup = updates.adadelta_updates(params, rgrads, *hparams,
+                                                 indices=rindices)
         elif algorithm == "adam":
             alpha = theano.tensor.scalar()
             beta1 = theano.tensor.scalar()
@@ -143,32 +255,74 @@ class optimizer:
             hparams = [alpha, beta1, beta2, epsilon]
             defaults = [("alpha", 0.001), ("beta1", 0.9), ("beta2", 0.999)]
             defaults.append(("epsilon", 1e-8))
-            svar, pup = updates.adam_updates(params, vec, *hparams)
+            svar, pup = updates.adam_updates(params, rgrads, *hparams,
+                                             indices=rindices)
         else:
             raise "Error: " + algorithm + " is not supported"
 
-        # restore variables used by optimizer
-        if option["initialize"]:
-            values = option["initialize"]
-            for v1, v2 in zip(svar, values):
-                v1.set_value(v2)
-
         if option["momentum"]:
             momentum = theano.tensor.scalar()
             hparams.append(momentum)
             defaults.append(("momentum", 0.9))
-            pup = updates.apply_momentum(pup, params, momentum)
+            mvar, pup = updates.apply_momentum(pup, params, momentum)
+            svar = svar + mvar
 
         if option["nesterov"]:
             momentum = theano.tensor.scalar()
             hparams.append(momentum)
             defaults.append(("momentum", 0.9))
-            pup = updates.apply_momentum(pup, params, momentum)
+            mvar, pup = updates.apply_momentum(pup, params, momentum)
+            svar = svar + mvar
+
+        # buffers are cleared after each update
+        if nbatch > 1:
+            for v, iv in zip(vec, ivec):
+                if iv is None:
+                    pup[v] = theano.tensor.zeros_like(v)
+                else:
+                    pup[v] = v[:0]
+                    pup[iv] = iv[:0]
 
-        optimize = theano.function(inputs, outputs, updates = gup)
-        update = theano.function(hparams, [], updates = pup)
+        # restore variables used by optimizer
+        if option["initialize"]:
+            values = option["initialize"]
+            shapes = [v.get_value(borrow=True).shape for v in svar]
+
+            # the state depends on options such as momentum and the trained
+            # variables, a mismatched state is discarded as a whole
+            if shapes != [v.shape for v in values]:
+                sys.stderr.write("warning: unmatched optimizer state, "
+                                 "starting with a new state\n")
+            else:
+                for v1, v2 in zip(svar, values):
+                    v1.set_value(v2)
+
+        # compiled functions are cached along with the model functions
+        cache = getattr(model, "cache", None)
+
+        if cache is not None:
+            keys = ["algorithm", "variant", "constraint", "momentum", "norm",
+                    "nesterov", "nanguard", "sparse", "fused", "accumulate"]
+            key = [(k, option[k]) for k in keys]
+            key.append(("variables", [p.name for p in params]))
+            cache = cache.extend(repr(key))
+
+        def function(name, inputs, outputs, updates):
+            if cache is None:
+                return theano.function(inputs, outputs, updates=updates)
+            return cache.function(name, inputs, outputs, updates=updates)
+
+        if option["fused"]:
+            gup.extend(pup.items())
+            fused = function("fused", inputs + hparams, outputs, updates=gup)
+            optimize = None
+            update = None
+        else:
+            fused = None
+            optimize = function("optimize", inputs, outputs, updates=gup)
+            update = function("update", hparams, uoutputs, updates=pup)
 
-        def wrapper(**option):
+        def get_values(**option):
             values = []
             for item in defaults:
                 name = item[0]
@@ -176,10 +330,35 @@ class optimizer:
                 if name not in option:
                     option[name] = val
                 values.append(option[name])
-            return update(*values)
+            return values
+
+        def wrapper(**option):
+            return update(*get_values(**option))
 
         self.optimize = optimize
-        self.update = wrapper
+        self.update = wrapper if update is not None else None
+        self.fused = fused
+        self.get_values = get_values
+        self.count = 0
+        self.variables = params
+        self.gradients = vec
+        self.gradient_indices = ivec
         self.option = option
         self.algorithm = algorithm
         self.parameter = svar
+
+    # computes gradients of a batch and updates parameters, the update is
+    # applied once every option["accumulate"] batches
+    # inputs: same as model.inputs, option: hyper-parameters
+    def step(self, *inputs, **option):
+        if self.fused is not None:
+            values = self.get_values(**option)
+            return self.fused(*(list(inputs) + values))
+
+        outputs = self.optimize(*inputs)
+        self.count += 1
+
+        if self.count % self.option["accumulate"] == 0:
+            self.update(**option)
+
+        return outputs
@@ -0,0 +1,222 @@
+# parallel.py
+# synchronous data-parallel training with worker processes
+# author: Playinf
+# email: playinf@stu.xmu.edu.cn
+
+import ops
+import numpy
+import ctypes
+import multiprocessing
+
+
+# numpy array backed by shared memory, inherited by forked processes
+def shared_array(shape, dtype):
+    dtype = numpy.dtype(dtype)
+    size = int(numpy.prod(shape))
+    nbytes = max(size, 1) * dtype.itemsize
+    buf = multiprocessing.RawArray(ctypes.c_char, nbytes)
+
+    return numpy.frombuffer(buf, dtype, size).reshape(shape)
+
+
+# gradient segment of a worker, sparse gradients also store row ids
+def gradient_segment(trainer):
+    segment = []
+
+    for p, iv in zip(trainer.variables, trainer.gradient_indices):
+        value = p.get_value(borrow=True)
+        rows = shared_array(value.shape, value.dtype)
+
+        if iv is None:
+            segment.append((rows, None))
+        else:
+            segment.append((rows, shared_array([value.shape[0]], "int32")))
+
+    return segment
+
+
+def worker_loop(trainer, conn, segment, seed):
+    vec = trainer.gradients
+    ivec = trainer.gradient_indices
+
+    # forked workers would otherwise share the dropout masks of the master
+    ops.random.seed(seed)
+
+    while True:
+        inputs = conn.recv()
+
+        if inputs is None:
+            break
+
+        try:
+            outputs = trainer.optimize(*inputs)
+            nrows = []
+
+            # gradients are copied to shared memory and cleared
+            for v, iv, (rows, ids) in zip(vec, ivec, segment):
+                value = v.get_value(borrow=True)
+                n = value.shape[0]
+                rows[:n] = value
+                nrows.append(n)
+
+                if iv is None:
+                    v.set_value(numpy.zeros_like(value), borrow=True)
+                else:
+                    ids[:n] = iv.get_value(borrow=True)
+                    v.set_value(value[:0].copy(), borrow=True)
+                    iv.set_value(numpy.zeros([0], "int32"), borrow=True)
+
+            conn.send((outputs, nrows))
+        except Exception as e:
+            conn.send(e)
+
+    conn.close()
+
+
+# each step splits a batch into shards, gradients of the shards are computed
+# by worker processes and the current process, and averaged through shared
+# memory before the update
+# trainer: optimizer.optimizer built with option["accumulate"] = n
+# n: number of processes, including the current one
+# axes: batch axis of each input, None if the input is shared by all shards
+# seed: random streams of the i-th worker are seeded with seed + i
+class data_parallel(object):
+
+    def __init__(self, trainer, n, axes, seed=None):
+        option = trainer.option
+
+        if option["fused"] or option["accumulate"] != n:
+            raise ValueError("trainer must accumulate gradients of n shards")
+
+        self._trainer = trainer
+        self._axes = axes
+        self._buffers = []
+        self._segments = []
+        self._conns = []
+        self._processes = []
+
+        # parameters are kept in shared memory, workers see every update
+        for p in trainer.variables:
+            value = p.get_value(borrow=True)
+            buf = shared_array(value.shape, value.dtype)
+            buf[...] = value
+            p.set_value(buf, borrow=True)
+            self._buffers.append(buf)
+
+        if seed is None:
+            seed = numpy.random.randint(2 ** 30)
+
+        for i in range(n - 1):
+            segment = gradient_segment(trainer)
+            conn, child_conn = multiprocessing.Pipe()
+            args = (trainer, child_conn, segment, (seed + i + 1) % 2 ** 30)
+            process = multiprocessing.Process(target=worker_loop, args=args)
+            process.daemon = True
+            process.start()
+            child_conn.close()
+            self._segments.append(segment)
+            self._conns.append(conn)
+            self._processes.append(process)
+
+    def _split(self, inputs):
+        n = len(self._conns) + 1
+        axis = [a for a in self._axes if a is not None][0]
+        size = inputs[self._axes.index(axis)].shape[axis]
+        # same as numpy.array_split, the first shards take the remainder
+        sizes = [size / n + (1 if i < size % n else 0) for i in range(n)]
+        bounds = numpy.cumsum([0] + sizes)
+        shards = []
+
+        for i in range(n):
+            lo, hi = bounds[i], bounds[i + 1]
+            shard = []
+
+            for item, a in zip(inputs, self._axes):
+                if a is None:
+                    shard.append(item)
+                else:
+                    shard.append(numpy.take(item, range(lo, hi), a))
+
+            shards.append((hi - lo, shard))
+
+        return size, shards
+
+    # same as optimizer.step
+    def step(self, *inputs, **option):
+        trainer = self._trainer
+        size, shards = self._split(inputs)
+        n = len(shards)
+
+        if size == 0:
+            raise ValueError("empty batch")
+
+        for conn, (m, shard) in zip(self._conns, shards[1:]):
+            if m > 0:
+                conn.send(shard)
+
+        # empty shards are skipped, their gradients have zero weight
+        weights = [float(m) / size for m, shard in shards]
+        costs = []
+        results = []
+        m, shard = shards[0]
+
+        if m > 0:
+            outputs = trainer.optimize(*shard)
+            costs.append(outputs[0] * weights[0])
+
+        for conn, (m, shard) in zip(self._conns, shards[1:]):
+            if m == 0:
+                results.append(None)
+                continue
+
+            result = conn.recv()
+
+            if isinstance(result, Exception):
+                raise result
+
+            results.append(result[1])
+            costs.append(result[0][0] * float(m) / size)
+
+        # update averages the sum of n gradients, sum of weights is 1
+        scales = [w * n for w in weights]
+
+        for i, (v, iv) in enumerate(zip(trainer.gradients,
+                                         trainer.gradient_indices)):
+            # buffers of the current process are empty if its shard is
+            value = v.get_value(borrow=True)
+            rows = [value * scales[0]]
+            ids = [] if iv is None else [iv.get_value(borrow=True)]
+
+            for scale, segment, nrows in zip(scales[1:], self._segments,
+                                             results):
+                if nrows is None:
+                    continue
+
+                buf, idx = segment[i]
+                rows.append(buf[:nrows[i]] * scale)
+                if idx is not None:
+                    ids.append(idx[:nrows[i]])
+
+            if iv is None:
+                v.set_value(sum(rows), borrow=True)
+            else:
+                v.set_value(numpy.concatenate(rows), borrow=True)
+                iv.set_value(numpy.concatenate(ids), borrow=True)
+
+        norm = trainer.update(**option)
+
+        # the update may not be in place
+        for p, buf in zip(trainer.variables, self._buffers):
+            value = p.get_value(borrow=True)
+            if value is not buf:
+                buf[...] = value
+                p.set_value(buf, borrow=True)
+
+        return [sum(costs)] + norm
+
+    def close(self):
+        for conn in self._conns:
+            conn.send(None)
+
+        for process in self._processes:
+            process.join()
@@ -0,0 +1,58 @@
+# sparse.py
+# row-wise gradients of parameters only used by embedding lookups
+# author: Playinf
+# email: playinf@stu.xmu.edu.cn
+
+import theano
+
+from theano.tensor.subtensor import AdvancedSubtensor1
+from theano.tensor.extra_ops import Unique
+
+
+# returns {param: [(rows, ids)]}, rows = param[ids], only matrices whose
+# every use in the graph is such a lookup are included, vectors such as
+# the bias selected by sampled softmax are updated densely
+def find_lookups(cost, params):
+    inputs = theano.gof.graph.inputs([cost])
+    nodes = theano.gof.graph.io_toposort(inputs, [cost])
+    lookups = dict([(p, []) for p in params if p.ndim == 2])
+    dense = set()
+
+    for node in nodes:
+        for i, var in enumerate(node.inputs):
+            if var not in lookups:
+                continue
+
+            if isinstance(node.op, AdvancedSubtensor1) and i == 0:
+                lookups[var].append((node.outputs[0], node.inputs[1]))
+            else:
+                dense.add(var)
+
+    return dict([(p, v) for p, v in lookups.iteritems()
+                 if v and p not in dense])
+
+
+# lookups: outputs of find_lookups for one parameter
+# grads: gradients of the looked up rows
+# returns [ids, grad], duplicated ids are summed, ids are unique
+def row_gradient(lookups, grads):
+    ids = [item[1] for item in lookups]
+
+    if len(ids) > 1:
+        ids = theano.tensor.concatenate(ids)
+        grads = theano.tensor.concatenate(grads)
+    else:
+        ids = ids[0]
+        grads = grads[0]
+
+    return merge_rows(ids, grads)
+
+
+# sums rows of grads with the same id, returns [unique_ids, grad]
+def merge_rows(ids, grads):
+    unique_ids, inverse = Unique(return_inverse=True)(ids)
+    shape = [unique_ids.shape[0], grads.shape[1]]
+    zeros = theano.tensor.zeros(shape, dtype=grads.dtype)
+    grad = theano.tensor.inc_subtensor(zeros[inverse], grads)
+
+    return [theano.tensor.cast(unique_ids, "int32"), grad]
@@ -7,6 +7,28 @@ import theano
 from collections import OrderedDict
 
 
+# indices: row indices of sparse gradients, None for dense gradients
+def _indices(params, indices):
+    if indices is None:
+        return [None] * len(params)
+    return indices
+
+
+# rows of a variable touched by a sparse gradient
+def _rows(var, index):
+    if index is None:
+        return var
+    return var[index]
+
+
+# only touched rows are written
+def _assign(updates, var, value, index):
+    if index is None:
+        updates[var] = value
+    else:
+        updates[var] = theano.tensor.set_subtensor(var[index], value)
+
+
 def apply_momentum(updates, params, momentum):
     sharedvars = []
     updates = OrderedDict(updates)
@@ -39,101 +61,107 @@ def apply_nesterov_momentum(updates, params, momentum):
     return sharedvars, updates
 
 
-def sgd_updates(params, grads, lr):
+def sgd_updates(params, grads, lr, indices=None):
     updates = OrderedDict()
 
-    for p, g in zip(params, grads):
-        updates[p] = p - lr * g
+    for p, g, i in zip(params, grads, _indices(params, indices)):
+        _assign(updates, p, _rows(p, i) - lr * g, i)
 
     return [], updates
 
 
-def adagrad_updates(params, grads, lr, epsilon):
+def adagrad_updates(params, grads, lr, epsilon, indices=None):
     sharedvars = []
     updates = OrderedDict()
+    indices = _indices(params, indices)
 
-    for param, grad in zip(params, grads):
+    for param, grad, index in zip(params, grads, indices):
         value = param.get_value(borrow=True)
         var = numpy.zeros_like(value)
         accu = theano.shared(var, broadcastable=param.broadcastable)
-        accu_new = accu + (grad ** 2)
+        accu_new = _rows(accu, index) + (grad ** 2)
         delta = lr * grad / theano.tensor.sqrt(accu_new + epsilon)
         sharedvars.append(accu)
-        updates[accu] = accu_new
-        updates[param] = param - delta
+        _assign(updates, accu, accu_new, index)
+        _assign(updates, param, _rows(param, index) - delta, index)
 
     return sharedvars, updates
 
 
-def rmsprop_updates(params, grads, lr, rho, epsilon, variant="graves"):
+def rmsprop_updates(params, grads, lr, rho, epsilon, variant="graves",
+                    indices=None):
     sharedvars = []
     updates = OrderedDict()
+    indices = _indices(params, indices)
 
     if variant == "hinton":
-        for param, grad in zip(params, grads):
+        for param, grad, index in zip(params, grads, indices):
             value = param.get_value(borrow=True)
             var = numpy.zeros_like(value)
             accu = theano.shared(var, broadcastable=param.broadcastable)
-            accu_new = rho * accu + (1 - rho) * grad ** 2
+            accu_new = rho * _rows(accu, index) + (1 - rho) * grad ** 2
             delta = lr * grad / (theano.tensor.sqrt(accu_new) + epsilon)
             sharedvars.append(accu)
-            updates[accu] = accu_new
-            updates[param] = param - delta
+            _assign(updates, accu, accu_new, index)
+            _assign(updates, param, _rows(param, index) - delta, index)
     elif variant == "graves":
-        for param, grad in zip(params, grads):
+        for param, grad, index in zip(params, grads, indices):
             value = numpy.zeros_like(param.get_value(borrow=True))
             accu = theano.shared(value, broadcastable=param.broadcastable)
             gaccu = theano.shared(value, broadcastable=param.broadcastable)
 
-            accu_new = rho * accu + (1 - rho) * (grad ** 2)
-            gaccu_new = rho * gaccu + (1 - rho) * grad
+            accu_new = rho * _rows(accu, index) + (1 - rho) * (grad ** 2)
+            gaccu_new = rho * _rows(gaccu, index) + (1 - rho) * grad
 
             sharedvars.append(accu)
             sharedvars.append(gaccu)
-            updates[accu] = accu_new
-            updates[gaccu] = gaccu_new
+            _assign(updates, accu, accu_new, index)
+            _assign(updates, gaccu, gaccu_new, index)
 
             denorm = theano.tensor.sqrt(accu_new - gaccu_new ** 2 + epsilon)
             delta = lr * grad / denorm
-            updates[param] = param - delta
+            _assign(updates, param, _rows(param, index) - delta, index)
     else:
         raise RuntimeError("error: unknown variant")
 
     return sharedvars, updates
 
 
-def rmsprop_momentum_updates(params, grads, lr, rho, epsilon, momentum):
+def rmsprop_momentum_updates(params, grads, lr, rho, epsilon, momentum,
+                             indices=None):
     sharedvars = []
     updates = OrderedDict()
+    indices = _indices(params, indices)
 
-    for param, grad in zip(params, grads):
+    for param, grad, index in zip(params, grads, indices):
         value = numpy.zeros_like(param.get_value(borrow=True))
         accu = theano.shared(value, broadcastable=param.broadcastable)
         grad_accu = theano.shared(value, broadcastable=param.broadcastable)
         velocity = theano.shared(value, broadcastable=param.broadcastable)
 
-        accu_new = rho * accu + (1 - rho) * (grad ** 2)
-        grad_accu_new = rho * grad_accu + (1 - rho) * grad
+        accu_new = rho * _rows(accu, index) + (1 - rho) * (grad ** 2)
+        grad_accu_new = rho * _rows(grad_accu, index) + (1 - rho) * grad
 
         sharedvars.append(accu)
         sharedvars.append(grad_accu)
         sharedvars.append(velocity)
-        updates[accu] = accu_new
-        updates[grad_accu] = grad_accu_new
+        _assign(updates, accu, accu_new, index)
+        _assign(updates, grad_accu, grad_accu_new, index)
 
         denorm = theano.tensor.sqrt(accu_new - grad_accu_new ** 2 + epsilon)
-        velocity_new = momentum * velocity - lr * grad / denorm
-        updates[velocity] = velocity_new
-        updates[param] = param + velocity_new
+        velocity_new = momentum * _rows(velocity, index) - lr * grad / denorm
+        _assign(updates, velocity, velocity_new, index)
+        _assign(updates, param, _rows(param, index) + velocity_new, index)
 
     return sharedvars, updates
 
 
-def adadelta_updates(params, grads, lr, rho, epsilon):
+def adadelta_updates(params, grads, lr, rho, epsilon, indices=None):
     sharedvars = []
     updates = OrderedDict()
+    indices = _indices(params, indices)
 
-    for param, grad in zip(params, grads):
+    for param, grad, index in zip(params, grads, indices):
         value = param.get_value(borrow=True)
         var = numpy.zeros_like(value)
         accu = theano.shared(var, broadcastable=param.broadcastable)
@@ -142,22 +170,25 @@ def adadelta_updates(params, grads, lr, rho, epsilon):
         sharedvars.append(accu)
         sharedvars.append(delta_accu)
 
-        accu_new = rho * accu + (1 - rho) * (grad ** 2)
-        updates[accu] = accu_new
+        accu_new = rho * _rows(accu, index) + (1 - rho) * (grad ** 2)
+        _assign(updates, accu, accu_new, index)
 
-        update = (grad * theano.tensor.sqrt(delta_accu + epsilon) /
+        delta_accu_t = _rows(delta_accu, index)
+        update = (grad * theano.tensor.sqrt(delta_accu_t + epsilon) /
                   theano.tensor.sqrt(accu_new + epsilon))
-        updates[param] = param - lr * update
+        _assign(updates, param, _rows(param, index) - lr * update, index)
 
-        delta_accu_new = rho * delta_accu + (1 - rho) * update ** 2
-        updates[delta_accu] = delta_accu_new
+        delta_accu_new = rho * delta_accu_t + (1 - rho) * update ** 2
+        _assign(updates, delta_accu, delta_accu_new, index)
 
     return sharedvars, updates
 
 
-def adam_updates(params, grads, lr, beta1, beta2, epsilon):
+# with sparse gradients, moments of untouched rows are not decayed (lazy Adam)
+def adam_updates(params, grads, lr, beta1, beta2, epsilon, indices=None):
     sharedvars = []
     updates = OrderedDict()
+    indices = _indices(params, indices)
 
     t_prev = theano.shared(numpy.asarray(0.0, dtype=theano.config.floatX))
     t = t_prev + 1
@@ -165,7 +196,7 @@ def adam_updates(params, grads, lr, beta1, beta2, epsilon):
 
     sharedvars.append(t_prev)
 
-    for param, g_t in zip(params, grads):
+    for param, g_t, index in zip(params, grads, indices):
         value = param.get_value(borrow=True)
         var = numpy.zeros_like(value)
         m_prev = theano.shared(var, broadcastable=param.broadcastable)
@@ -174,13 +205,13 @@ def adam_updates(params, grads, lr, beta1, beta2, epsilon):
         sharedvars.append(m_prev)
         sharedvars.append(v_prev)
 
-        m_t = beta1 * m_prev + (1 - beta1) * g_t
-        v_t = beta2 * v_prev + (1 - beta2) * (g_t ** 2)
+        m_t = beta1 * _rows(m_prev, index) + (1 - beta1) * g_t
+        v_t = beta2 * _rows(v_prev, index) + (1 - beta2) * (g_t ** 2)
         step = a_t * m_t / (theano.tensor.sqrt(v_t) + epsilon)
 
-        updates[m_prev] = m_t
-        updates[v_prev] = v_t
-        updates[param] = param - step
+        _assign(updates, m_prev, m_t, index)
+        _assign(updates, v_prev, v_t, index)
+        _assign(updates, param, _rows(param, index) - step, index)
 
     updates[t_prev] = t
 
@@ -7,16 +7,22 @@ import ops
 import sys
 import math
 import time
+import re
 import numpy
 import cPickle
 import argparse
 
 from metric import bleu
-from optimizer import optimizer
-from data import textreader, textiterator
+from optimizer import optimizer, data_parallel
+from data import textreader, textiterator, bucketiterator, prefetcher
 from data.align import convert_align
 from data.plain import convert_data, data_length
-from model.rnnsearch import rnnsearch, beamsearch, batchsample, evaluate_model
+from data.binary import is_binary_corpus, binarize, binaryreader, convert_ids
+from model.rnnsearch import rnnsearch, beamsearch, batched_beamsearch
+from model.rnnsearch import batchsample, evaluate_model
+from model.numpy_rnnsearch import numpy_rnnsearch
+from utils.checkpoint import is_mmap_checkpoint, load_mmap
+from utils.checkpoint import atomic_save, checkpoint_writer
 
 
 def load_vocab(file):
@@ -38,43 +44,65 @@ def count_parameters(variables):
     n = 0
 
     for item in variables:
-        v = item.get_value()
+        v = item.get_value(borrow=True)
         n += v.size
 
     return n
 
 
-def serialize(name, option):
-    fd = open(name, "w")
-    params = ops.trainable_variables()
-    names = [p.name for p in params]
-    vals = dict([(p.name, p.get_value()) for p in params])
+# parameter values are copied, training can continue while they are written
+# state: shared variables of the optimizer, stored along with parameters
+# params: a list of (name, value) as returned by load_model, trainable
+# variables are used if not given
+def snapshot(option, state=None, params=None):
+    if params is None:
+        params = [(p.name, p.get_value()) for p in ops.trainable_variables()]
 
-    if option["indices"] != None:
-        indices = option["indices"]
-        vals["indices"] = indices
+    names = [n for n, v in params]
+    vals = dict(params)
+    option = dict(option)
+
+    if option.get("indices") is not None:
+        vals["indices"] = option["indices"]
         option["indices"] = None
-    else:
-        indices = None
 
+    for i, var in enumerate(state or []):
+        vals["optimizer/%d" % i] = var.get_value()
+
+    return option, names, vals
+
+
+def write_model(fd, option, names, vals):
     cPickle.dump(option, fd)
     cPickle.dump(names, fd)
     # compress
     numpy.savez(fd, **vals)
 
-    # restore
-    if indices is not None:
-        option["indices"] = indices
 
-    fd.close()
+def serialize(name, option, state=None, params=None):
+    atomic_save(name, write_model, *snapshot(option, state, params))
 
 
 # load model from file
-def load_model(name):
+# mmap_mode: used by memory-mapped checkpoints, "r" or "c"
+def load_model(name, mmap_mode="r"):
+    if is_mmap_checkpoint(name):
+        option, tensors = load_mmap(name, mmap_mode)
+        params = []
+
+        for n, v in tensors:
+            if n == "indices":
+                option["indices"] = v
+            elif not n.startswith("optimizer/"):
+                params.append((n, v))
+
+        return option, params
+
     fd = open(name, "r")
     option = cPickle.load(fd)
     names = cPickle.load(fd)
-    vals = dict(numpy.load(fd))
+    # optimizer state is not read
+    vals = numpy.load(fd)
 
     params = [(n, vals[n]) for n in names]
 
@@ -86,6 +114,29 @@ def load_model(name):
     return option, params
 
 
+# optimizer state saved by train, an empty list if not available
+def load_optimizer_state(name):
+    state = []
+
+    if is_mmap_checkpoint(name):
+        option, tensors = load_mmap(name)
+        vals = dict(tensors)
+        fd = None
+    else:
+        fd = open(name, "r")
+        option = cPickle.load(fd)
+        names = cPickle.load(fd)
+        vals = numpy.load(fd)
+
+    while "optimizer/%d" % len(state) in vals:
+        state.append(vals["optimizer/%d" % len(state)])
+
+    if fd is not None:
+        fd.close()
+
+    return state
+
+
 def match_variables(variables, values, ignore_prefix=True):
     var_dict = {}
     val_dict = {}
@@ -117,7 +168,7 @@ def match_variables(variables, values, ignore_prefix=True):
 
 def restore_variables(matched, not_matched):
     for var, val in matched:
-        var.set_value(val)
+        var.set_value(val, borrow=True)
 
     for var in not_matched:
         sys.stderr.write("%s NOT restored\n" % var.name)
@@ -126,8 +177,9 @@ def restore_variables(matched, not_matched):
 def set_variables(variables, values):
     values = [item[1] for item in values]
 
+    # values are used directly, no copy is made
     for p, v in zip(variables, values):
-        p.set_value(v)
+        p.set_value(v, borrow=True)
 
 
 def get_variables_with_prefix(prefix):
@@ -141,6 +193,14 @@ def get_variables_with_prefix(prefix):
     return new_list
 
 
+# binarized corpora yield token ids instead of lines
+def to_text(data, ivocab):
+    if isinstance(data, basestring):
+        return data
+
+    return " ".join([ivocab[i] for i in data])
+
+
 def load_references(names, case=True):
     references = []
     reader = textreader(names)
@@ -166,6 +226,18 @@ def load_references(names, case=True):
 
 # format: source target prob
 def load_dictionary(filename):
+    mapping = load_lexicon(filename, 1)
+
+    for item in mapping:
+        mapping[item] = mapping[item][0]
+
+    return mapping
+
+
+# format: source target prob
+# keep the n most probable translations of each source word, ties are kept
+# in file order
+def load_lexicon(filename, n):
     fd = open(filename)
 
     mapping = {}
@@ -175,19 +247,34 @@ def load_dictionary(filename):
         prob = float(prob)
 
         if sword in mapping:
-            oldword, oldprob = mapping[sword]
-            if prob > oldprob:
-                mapping[sword] = (tword, prob)
+            mapping[sword].append((prob, tword))
         else:
-            mapping[sword] = (tword, prob)
+            mapping[sword] = [(prob, tword)]
 
-    newmapping = {}
     for item in mapping:
-        newmapping[item] = mapping[item][0]
+        translations = sorted(mapping[item], key=lambda x: x[0],
+                              reverse=True)[:n]
+        mapping[item] = [tword for prob, tword in translations]
 
     fd.close()
 
-    return newmapping
+    return mapping
+
+
+# candidate target words of a batch: translations of source words plus
+# the most frequent target words, vocabulary is assumed to be sorted by
+# frequency
+def build_shortlist(data, lexicon, vocab, nfreq, extra_ids):
+    candidates = set(range(min(nfreq, len(vocab))))
+    candidates.update(extra_ids)
+
+    for line in data:
+        for sword in line.strip().split():
+            for tword in lexicon.get(sword, []):
+                if tword in vocab:
+                    candidates.add(vocab[tword])
+
+    return numpy.array(sorted(candidates), "int32")
 
 
 def build_sample_space(refs, examples):
@@ -211,23 +298,50 @@ def build_sample_space(refs, examples):
     return list(space.iterkeys())
 
 
-def translate(model, corpus, **opt):
+# target vocabulary of a batch used by sampled softmax: gold words plus
+# words drawn from a log-uniform distribution over a vocabulary sorted by
+# frequency, correction is the log probability of including each word
+def sample_candidates(ydata, vocab_size, nsample, dtype="float32"):
+    gold = numpy.unique(ydata)
+
+    # P(k) = log((k + 2) / (k + 1)) / log(vocab_size + 1)
+    logv = numpy.log(vocab_size + 1.0)
+    sampled = numpy.exp(numpy.random.uniform(0.0, logv, nsample)) - 1.0
+    sampled = numpy.clip(sampled.astype("int32"), 0, vocab_size - 1)
+    candidates = numpy.union1d(gold, sampled).astype("int32")
+
+    prob = numpy.log((candidates + 2.0) / (candidates + 1.0)) / logv
+    # probability of being drawn at least once
+    prob = 1.0 - (1.0 - prob) ** nsample
+    correction = numpy.log(prob)
+    # gold words are always included
+    correction[numpy.in1d(candidates, gold)] = 0.0
+
+    index = numpy.searchsorted(candidates, ydata).astype("int32")
+
+    return candidates, index, correction.astype(dtype)
+
+
+def translate(model, corpus, batch=1, **opt):
     fd = open(corpus, "r")
     svocab = model.option["vocabulary"][0][0]
     unk_symbol = model.option["unk"]
     eos_symbol = model.option["eos"]
 
     trans = []
+    lines = [line.strip() for line in fd]
 
-    for line in fd:
-        line = line.strip()
-        data, mask = convert_data([line], svocab, unk_symbol, eos_symbol)
-        hypo_list = beamsearch(model, data, **opt)
-        if len(hypo_list) > 0:
-            best, score = hypo_list[0]
-            trans.append(best[:-1])
-        else:
-            trans.append([])
+    for i in range(0, len(lines), batch):
+        data = lines[i:i + batch]
+        data, mask = convert_data(data, svocab, unk_symbol, eos_symbol)
+        hypo_lists = batched_beamsearch(model, data, mask, **opt)
+
+        for hypo_list in hypo_lists:
+            if len(hypo_list) > 0:
+                best, score = hypo_list[0]
+                trans.append(best[:-1])
+            else:
+                trans.append([])
 
     fd.close()
 
@@ -258,6 +372,8 @@ def parseargs_train(args):
     parser.add_argument("--maxpart", type=int, help=msg)
     msg = "deepout hidden dimension, default 620"
     parser.add_argument("--deephid", type=int, help=msg)
+    msg = "recurrent cell, gru or fused_gru, default gru"
+    parser.add_argument("--cell", type=str, help=msg)
     msg = "maximum training epoch, default 5"
     parser.add_argument("--maxepoch", type=int, help=msg)
 
@@ -268,10 +384,22 @@ def parseargs_train(args):
     parser.add_argument("--momentum", type=float, help=msg)
     msg = "batch size, default 128"
     parser.add_argument("--batch", type=int, help=msg)
+    msg = "maximum source and target tokens of a batch including padding "
+    msg += "and <eos>, batch is the maximum number of sentences, default 0 "
+    msg += "(disabled)"
+    parser.add_argument("--batch-tokens", type=int, nargs="+", help=msg)
     msg = "optimizer, default rmsprop"
     parser.add_argument("--optimizer", type=str, help=msg)
     msg = "gradient clipping, default 1.0"
     parser.add_argument("--norm", type=float, help=msg)
+    msg = "only update embedding rows used by each batch, default 0"
+    parser.add_argument("--sparse-update", type=int, help=msg)
+    msg = "apply updates without gradient buffers, default 0"
+    parser.add_argument("--fused-update", type=int, help=msg)
+    msg = "number of batches accumulated before an update, default 1"
+    parser.add_argument("--accumulate", type=int, help=msg)
+    msg = "number of processes sharing each batch, default 1"
+    parser.add_argument("--parallel", type=int, help=msg)
     msg = "early stopping iteration, default 0"
     parser.add_argument("--stop", type=int, help=msg)
     msg = "decay factor, default 0.5"
@@ -284,6 +412,8 @@ def parseargs_train(args):
     parser.add_argument("--l2-scale", type=float, help=msg)
     msg = "dropout keep probability"
     parser.add_argument("--keep-prob", type=float, help=msg)
+    msg = "sampled softmax, number of sampled target words, 0 to disable"
+    parser.add_argument("--sampled-softmax", type=int, help=msg)
 
     # validation
     msg = "random seed, default 1234"
@@ -298,8 +428,13 @@ def parseargs_train(args):
     parser.add_argument("--sort", type=int, help=msg)
     msg = "shuffle every epcoh"
     parser.add_argument("--shuffle", type=int, help=msg)
+    msg = "length range of buckets, batches of sort * batch sentences are "
+    msg += "bucketed and emitted in random order, default 0 (disabled)"
+    parser.add_argument("--bucket", type=int, help=msg)
     msg = "source and target sentence limit, default 50 (both), 0 to disable"
     parser.add_argument("--limit", type=int, nargs='+', help=msg)
+    msg = "batches prepared by a background process, default 0 (disabled)"
+    parser.add_argument("--prefetch", type=int, help=msg)
 
     # control frequency
     msg = "save frequency, default 1000"
@@ -308,6 +443,8 @@ def parseargs_train(args):
     parser.add_argument("--sfreq", type=int, help=msg)
     msg = "validation frequency, default 1000"
     parser.add_argument("--vfreq", type=int, help=msg)
+    msg = "numbered checkpoints kept, saved with autosave, default 0 (none)"
+    parser.add_argument("--keep-checkpoints", type=int, help=msg)
 
     # control beamsearch
     msg = "beam size, default 10"
@@ -318,6 +455,8 @@ def parseargs_train(args):
     parser.add_argument("--maxlen", type=int, help=msg)
     msg = "min translation length"
     parser.add_argument("--minlen", type=int, help=msg)
+    msg = "validation decoding batch size, default 32"
+    parser.add_argument("--vbatch", type=int, help=msg)
 
     # mrt training
     msg = "criterion, mle or mrt"
@@ -336,6 +475,8 @@ def parseargs_train(args):
     parser.add_argument("--reset", action="store_true", help=msg)
     msg = "skip validation phase"
     parser.add_argument("--skip-val", action="store_true", help=msg)
+    msg = "directory of cached compiled functions"
+    parser.add_argument("--cache", type=str, help=msg)
 
     return parser.parse_args(args)
 
@@ -359,6 +500,20 @@ def parseargs_decode(args):
     parser.add_argument("--minlen", type=int, help=msg)
     msg = "oracle texts"
     parser.add_argument("--oracle", type=str, nargs="+", help=msg)
+    msg = "number of sentences decoded together"
+    parser.add_argument("--batch", default=1, type=int, help=msg)
+    msg = "only fetch the best words of each hypothesis (single model)"
+    parser.add_argument("--topk", action="store_true", help=msg)
+    msg = "restrict target vocabulary using a lexical translation table"
+    parser.add_argument("--shortlist", type=str, help=msg)
+    msg = "translations kept for each source word, default 10"
+    parser.add_argument("--ntrans", default=10, type=int, help=msg)
+    msg = "frequent target words always in the shortlist, default 2000"
+    parser.add_argument("--nfreq", default=2000, type=int, help=msg)
+    msg = "decode with the NumPy implementation, no graph compilation"
+    parser.add_argument("--numpy", action="store_true", help=msg)
+    msg = "directory of cached compiled functions"
+    parser.add_argument("--cache", type=str, help=msg)
 
     return parser.parse_args(args)
 
@@ -374,6 +529,8 @@ def parseargs_sample(args):
     parser.add_argument("--batch", default=1, type=int, help=msg)
     msg = "max sentence length"
     parser.add_argument("--maxlen", type=int, help=msg)
+    msg = "directory of cached compiled functions"
+    parser.add_argument("--cache", type=str, help=msg)
 
     return parser.parse_args(args)
 
@@ -395,6 +552,8 @@ def parseargs_replace(args):
     parser.add_argument("--batch", type=int, default=128, help=msg)
     msg = "use arithmetic mean instead of geometric mean"
     parser.add_argument("--arithmetic", action="store_true", help=msg)
+    msg = "directory of cached compiled functions"
+    parser.add_argument("--cache", type=str, help=msg)
 
     return parser.parse_args(args)
 
@@ -416,6 +575,27 @@ def parseargs_evaluate(args):
     parser.add_argument("--align", type=str, help=msg)
     msg = "print more informations"
     parser.add_argument("--verbose", action="store_true", help=msg)
+    msg = "directory of cached compiled functions"
+    parser.add_argument("--cache", type=str, help=msg)
+
+    return parser.parse_args(args)
+
+
+def parseargs_binarize(args):
+    msg = "binarize a corpus for training"
+    usage = "rnnsearch.py binarize [<args>] [-h | --help]"
+    parser = argparse.ArgumentParser(description=msg, usage=usage)
+
+    msg = "text files, one for each side of the corpus"
+    parser.add_argument("--corpus", required=True, nargs="+", help=msg)
+    msg = "vocabulary of each file"
+    parser.add_argument("--vocab", required=True, nargs="+", help=msg)
+    msg = "binarized files"
+    parser.add_argument("--output", required=True, nargs="+", help=msg)
+    msg = "unknown symbol, default UNK"
+    parser.add_argument("--unk", default="UNK", type=str, help=msg)
+    msg = "end of sentence symbol, default <eos>"
+    parser.add_argument("--eos", default="<eos>", type=str, help=msg)
 
     return parser.parse_args(args)
 
@@ -433,19 +613,26 @@ def default_option():
     option["maxpart"] = 2
     option["maxhid"] = 500
     option["deephid"] = 620
+    option["cell"] = "gru"
 
     # tuning options
     option["alpha"] = 5e-4
     option["batch"] = 128
+    option["batch_tokens"] = None
     option["momentum"] = 0.0
     option["optimizer"] = "rmsprop"
     option["norm"] = 1.0
+    option["sparse_update"] = False
+    option["fused_update"] = False
+    option["accumulate"] = 1
+    option["parallel"] = 1
     option["stop"] = 0
     option["decay"] = 0.5
     option["scale"] = 0.08
     option["l1_scale"] = None
     option["l2_scale"] = None
     option["keep_prob"] = None
+    option["sampled_softmax"] = None
 
     # runtime information
     option["cost"] = 0.0
@@ -455,10 +642,13 @@ def default_option():
     option["maxepoch"] = 5
     option["sort"] = 20
     option["shuffle"] = False
+    option["bucket"] = 0
     option["limit"] = [50, 50]
+    option["prefetch"] = 0
     option["freq"] = 1000
     option["vfreq"] = 1000
     option["sfreq"] = 50
+    option["keep_checkpoints"] = 0
     option["seed"] = 1234
     option["validation"] = None
     option["references"] = None
@@ -470,6 +660,7 @@ def default_option():
     option["normalize"] = False
     option["maxlen"] = None
     option["minlen"] = None
+    option["vbatch"] = 32
 
     # special symbols
     option["unk"] = "UNK"
@@ -493,7 +684,8 @@ def override_if_not_none(opt1, opt2, key):
     else:
         value = None
 
-    opt1[key] = value if value != None else opt1[key]
+    # options saved by older versions may lack newly added keys
+    opt1[key] = value if value != None else opt1.get(key)
 
 
 # override default options
@@ -513,6 +705,12 @@ def override(option, args):
     if args["limit"] and len(args["limit"]) == 1:
         args["limit"] = args["limit"] * 2
 
+    if args["batch_tokens"] and len(args["batch_tokens"]) > 2:
+        raise ValueError("error: invalid number of --batch-tokens argument")
+
+    if args["batch_tokens"] and len(args["batch_tokens"]) == 1:
+        args["batch_tokens"] = args["batch_tokens"] * 2
+
     override_if_not_none(option, args, "corpus")
 
     # vocabulary and model paramters cannot be overrided
@@ -543,20 +741,27 @@ def override(option, args):
         override_if_not_none(option, args, "maxhid")
         override_if_not_none(option, args, "maxpart")
         override_if_not_none(option, args, "deephid")
+        override_if_not_none(option, args, "cell")
 
     # training options
     override_if_not_none(option, args, "maxepoch")
     override_if_not_none(option, args, "alpha")
     override_if_not_none(option, args, "momentum")
     override_if_not_none(option, args, "batch")
+    override_if_not_none(option, args, "batch_tokens")
     override_if_not_none(option, args, "optimizer")
     override_if_not_none(option, args, "norm")
+    override_if_not_none(option, args, "sparse_update")
+    override_if_not_none(option, args, "fused_update")
+    override_if_not_none(option, args, "accumulate")
+    override_if_not_none(option, args, "parallel")
     override_if_not_none(option, args, "stop")
     override_if_not_none(option, args, "decay")
     override_if_not_none(option, args, "scale")
     override_if_not_none(option, args, "l1_scale")
     override_if_not_none(option, args, "l2_scale")
     override_if_not_none(option, args, "keep_prob")
+    override_if_not_none(option, args, "sampled_softmax")
 
     # runtime information
     override_if_not_none(option, args, "cost")
@@ -565,10 +770,13 @@ def override(option, args):
     override_if_not_none(option, args, "maxepoch")
     override_if_not_none(option, args, "sort")
     override_if_not_none(option, args, "shuffle")
+    override_if_not_none(option, args, "bucket")
     override_if_not_none(option, args, "limit")
+    override_if_not_none(option, args, "prefetch")
     override_if_not_none(option, args, "freq")
     override_if_not_none(option, args, "vfreq")
     override_if_not_none(option, args, "sfreq")
+    override_if_not_none(option, args, "keep_checkpoints")
     override_if_not_none(option, args, "seed")
     override_if_not_none(option, args, "validation")
     override_if_not_none(option, args, "references")
@@ -580,6 +788,7 @@ def override(option, args):
     override_if_not_none(option, args, "normalize")
     override_if_not_none(option, args, "maxlen")
     override_if_not_none(option, args, "minlen")
+    override_if_not_none(option, args, "vbatch")
 
     # training criterion
     override_if_not_none(option, args, "criterion")
@@ -603,34 +812,45 @@ def print_option(option):
     print "maxhid:", option["maxhid"]
     print "maxpart:", option["maxpart"]
     print "deephid:", option["deephid"]
+    print "cell:", option.get("cell", "gru")
 
     print "maxepoch:", option["maxepoch"]
     print "alpha:", option["alpha"]
     print "momentum:", option["momentum"]
     print "batch:", option["batch"]
+    print "batch-tokens:", option.get("batch_tokens")
     print "optimizer:", option["optimizer"]
     print "norm:", option["norm"]
+    print "sparse-update:", option.get("sparse_update", False)
+    print "fused-update:", option.get("fused_update", False)
+    print "accumulate:", option.get("accumulate", 1)
+    print "parallel:", option.get("parallel", 1)
     print "stop:", option["stop"]
     print "decay:", option["decay"]
     print "scale:", option["scale"]
     print "L1-scale:", option["l1_scale"]
     print "L2-scale:", option["l2_scale"]
     print "keep-prob:", option["keep_prob"]
+    print "sampled-softmax:", option["sampled_softmax"]
 
     print "validation:", option["validation"]
     print "references:", option["references"]
     print "freq:", option["freq"]
     print "vfreq:", option["vfreq"]
     print "sfreq:", option["sfreq"]
+    print "keep-checkpoints:", option.get("keep_checkpoints", 0)
     print "seed:", option["seed"]
     print "sort:", option["sort"]
     print "shuffle:", option["shuffle"]
+    print "bucket:", option.get("bucket", 0)
     print "limit:", option["limit"]
+    print "prefetch:", option.get("prefetch", 0)
 
     print "beamsize:", option["beamsize"]
     print "normalize:", option["normalize"]
     print "maxlen:", option["maxlen"]
     print "minlen:", option["minlen"]
+    print "vbatch:", option["vbatch"]
 
     # training criterion
     print "criterion:", option["criterion"]
@@ -652,6 +872,25 @@ def get_filename(name):
     return s[0]
 
 
+# checkpoint saved at the given epoch and batch count
+def get_numbered_name(pathname, modelname, epoch, count):
+    return os.path.join(pathname, "%s.%d-%d.pkl" % (modelname, epoch, count))
+
+
+# existing numbered checkpoints, oldest first
+def find_numbered_names(pathname, modelname):
+    pattern = re.compile(re.escape(modelname) + r"\.(\d+)-(\d+)\.pkl$")
+    checkpoints = []
+
+    for name in os.listdir(pathname or "."):
+        match = pattern.match(name)
+        if match:
+            key = (int(match.group(1)), int(match.group(2)))
+            checkpoints.append((key, os.path.join(pathname, name)))
+
+    return [name for key, name in sorted(checkpoints)]
+
+
 def train(args):
     option = default_option()
 
@@ -663,14 +902,21 @@ def train(args):
 
     # load models
     if os.path.exists(args.model):
-        opt, params = load_model(args.model)
-        option = opt
+        # parameters are updated in place, pages must not be shared
+        opt, params = load_model(args.model, "c")
+        state = load_optimizer_state(args.model)
+        # options added after the checkpoint was saved take their defaults
+        option.update(opt)
         init = False
     else:
+        state = []
         init = True
 
+    # optimizer state is only restored with the same algorithm
+    algorithm = option["optimizer"]
+
     if args.initialize:
-        init_params = load_model(args.initialize)
+        init_params = load_model(args.initialize, "c")
         init_params = init_params[1]
         restore = True
     else:
@@ -693,14 +939,42 @@ def train(args):
     if criterion == "mrt":
         sys.stderr.write("warning: In MRT mode, batch is set to 1\n")
 
+    # vocabulary and special symbol
+    svocabs, tvocabs = option["vocabulary"]
+    svocab, isvocab = svocabs
+    tvocab, itvocab = tvocabs
+    unk_sym = option["unk"]
+    eos_sym = option["eos"]
+
     # input corpus
     batch = option["batch"] if criterion == "mle" else 1
     sortk = option["sort"] or 1 if criterion == "mle" else 1
     shuffle = option["seed"] if option["shuffle"] else None
-    reader = textreader(option["corpus"], shuffle)
-    processor = [data_length, data_length]
-    stream = textiterator(reader, [batch, batch * sortk], processor,
-                          option["limit"], option["sort"])
+    binary = is_binary_corpus(option["corpus"][0])
+
+    if binary:
+        reader = binaryreader(option["corpus"], shuffle)
+        processor = [len, len]
+
+        for name, header, vocab in zip(reader.names, reader.headers,
+                                       [svocab, tvocab]):
+            if (header["vocab_size"] != len(vocab) or
+                header["unk"] != unk_sym or header["eos"] != eos_sym):
+                raise ValueError("%s does not match the vocabulary" % name)
+    else:
+        reader = textreader(option["corpus"], shuffle)
+        processor = [data_length, data_length]
+
+    tokens = option["batch_tokens"] if criterion == "mle" else None
+    width = option["bucket"] if criterion == "mle" else None
+
+    if width:
+        stream = bucketiterator(reader, [batch, batch * sortk], processor,
+                                option["limit"], option["sort"], tokens,
+                                width, option["seed"])
+    else:
+        stream = textiterator(reader, [batch, batch * sortk], processor,
+                              option["limit"], option["sort"], tokens)
 
     if shuffle and option["indices"] is not None:
         reader.set_indices(option["indices"])
@@ -711,6 +985,18 @@ def train(args):
         option["cost"] = 0.0
 
     skip_stream(reader, option["count"][1])
+
+    def convert(data):
+        if binary:
+            xdata, xmask = convert_ids(data[0], svocab[eos_sym])
+            ydata, ymask = convert_ids(data[1], tvocab[eos_sym])
+        else:
+            xdata, xmask = convert_data(data[0], svocab, unk_sym, eos_sym)
+            ydata, ymask = convert_data(data[1], tvocab, unk_sym, eos_sym)
+        return data, xdata, xmask, ydata, ymask
+
+    # the process is forked before the model is built
+    stream = prefetcher(stream, convert, option["prefetch"] or 0)
     epoch = option["epoch"]
     maxepoch = option["maxepoch"]
 
@@ -728,8 +1014,11 @@ def train(args):
     regularizer = ops.sum_regularizer(regularizer)
     # set seed
     numpy.random.seed(option["seed"])
-    model = rnnsearch(initializer=initializer, regularizer=regularizer,
-                      **option)
+
+    # parameters of a saved model are assigned from the checkpoint
+    with ops.deferred_initialization(not init):
+        model = rnnsearch(initializer=initializer, regularizer=regularizer,
+                          cache=args.cache, **option)
 
     variables = None
 
@@ -747,17 +1036,52 @@ def train(args):
     if restore:
         restore_variables(matched, not_matched)
 
+    ops.initialize_variables()
+
     print "parameters:", count_parameters(ops.trainable_variables())
 
+    # checkpoints are written in background
+    keep = option["keep_checkpoints"] or 0
+    numbered = find_numbered_names(pathname, modelname)
+    writer = checkpoint_writer(write_model, keep, numbered)
+
     # tuning option
     tune_opt = {}
     tune_opt["algorithm"] = option["optimizer"]
     tune_opt["constraint"] = ("norm", option["norm"])
     tune_opt["norm"] = True
+    tune_opt["sparse"] = option["sparse_update"]
+    tune_opt["fused"] = option["fused_update"]
+    tune_opt["accumulate"] = option["accumulate"] or 1
+    nproc = option["parallel"] or 1
+
+    if nproc > 1:
+        if criterion == "mrt" or tune_opt["fused"]:
+            raise ValueError("--parallel only supports mle without fusion")
+        if tune_opt["accumulate"] > 1:
+            raise ValueError("--parallel can not accumulate gradients")
+        # gradients of all processes are summed by the optimizer
+        tune_opt["accumulate"] = nproc
     tune_opt["variables"] = variables
 
+    if state and option["optimizer"] == algorithm:
+        tune_opt["initialize"] = state
+
     # create optimizer
     trainer = optimizer(model, **tune_opt)
+    # saved in checkpoints along with parameters
+    state = trainer.parameter
+    step = trainer.step
+
+    # worker processes are forked after compilation
+    if nproc > 1:
+        # batch axis of each input
+        if option["sampled_softmax"]:
+            axes = [1, 1, 1, 1, None, 1, None]
+        else:
+            axes = [1, 1, 1, 1]
+        workers = data_parallel(trainer, nproc, axes, option["seed"])
+        step = workers.step
 
     # beamsearch option
     search_opt = {}
@@ -765,13 +1089,7 @@ def train(args):
     search_opt["normalize"] = option["normalize"]
     search_opt["maxlen"] = option["maxlen"]
     search_opt["minlen"] = option["minlen"]
-
-    # vocabulary and special symbol
-    svocabs, tvocabs = option["vocabulary"]
-    svocab, isvocab = svocabs
-    tvocab, itvocab = tvocabs
-    unk_sym = option["unk"]
-    eos_sym = option["eos"]
+    search_opt["batch"] = option["vbatch"] or 1
 
     # summary
     count = option["count"][0]
@@ -780,130 +1098,167 @@ def train(args):
     alpha = option["alpha"]
     sharp = option["sharp"]
 
-    for i in range(epoch, maxepoch):
-        for data in stream:
-            xdata, xmask = convert_data(data[0], svocab, unk_sym, eos_sym)
-            ydata, ymask = convert_data(data[1], tvocab, unk_sym, eos_sym)
-
-            if criterion == "mrt":
-                refs = []
-
-                for item in data[1]:
-                    item = item.split()
-                    item = [unk_sym if word not in tvocab else word
-                            for word in item]
-                    refs.append(" ".join(item))
-
-                t1 = time.time()
-
-                # sample from model
-                nsample = option["sample"] - len(refs)
-                xdata = numpy.repeat(xdata, nsample, 1)
-                xmask = numpy.repeat(xmask, nsample, 1)
-                maxlen = int(1.5 * len(ydata))
-                examples = batchsample(model, xdata, xmask, maxlen)
-                space = build_sample_space(refs, examples)
-                score = numpy.zeros((len(space),), "float32")
-
-                refs = [ref.split() for ref in refs]
-
-                for j in range(len(space)):
-                    example = space[j].split()
-                    score[j] = 1.0 - bleu([example], [refs], smoothing=True)
-
-                ydata, ymask = convert_data(space, tvocab, unk_sym, eos_sym)
-                cost, norm = trainer.optimize(xdata[:, 0:1], xmask[:, 0:1],
-                                              ydata, ymask, score, sharp)
-                trainer.update(alpha=alpha)
-                t2 = time.time()
-
-                totcost += cost
-                count += 1
-                t = t2 - t1
-                ac = totcost / count
-                print i + 1, count, len(space), cost, norm, ac, t
-            else:
-                t1 = time.time()
-                cost, norm = trainer.optimize(xdata, xmask, ydata, ymask)
-                trainer.update(alpha = alpha)
-                t2 = time.time()
-
-                count += 1
-                cost = cost * ymask.shape[1] / ymask.sum()
-                totcost += cost / math.log(2)
-                print i + 1, count, cost, norm, t2 - t1
-
-            # autosave
-            if count % option["freq"] == 0:
-                option["indices"] = reader.get_indices()
-                option["bleu"] = best_score
-                option["cost"] = totcost
-                option["count"] = [count, reader.count]
-                serialize(autoname, option)
-
-            if count % option["vfreq"] == 0:
-                if option["validation"] and references:
-                    trans = translate(model, option["validation"],
-                                      **search_opt)
-                    bleu_score = bleu(trans, references)
-                    print "bleu: %2.4f" % bleu_score
-                    if bleu_score > best_score:
-                        best_score = bleu_score
-                        option["indices"] = reader.get_indices()
-                        option["bleu"] = best_score
-                        option["cost"] = totcost
-                        option["count"] = [count, reader.count]
-                        serialize(bestname, option)
-
-            if count % option["sfreq"] == 0:
-                n = len(data[0])
-                ind = numpy.random.randint(0, n)
-                sdata = data[0][ind]
-                tdata = data[1][ind]
-                xdata = xdata[:, ind : ind + 1]
-                xmask = xmask[:, ind : ind + 1]
-                hls = beamsearch(model, xdata, xmask)
-                best, score = hls[0]
-                print sdata
-                print tdata
-                print " ".join(best[:-1])
-
-
-        print "--------------------------------------------------"
-
-        if option["validation"] and references:
-            trans = translate(model, option["validation"], **search_opt)
-            bleu_score = bleu(trans, references)
-            print "iter: %d, bleu: %2.4f" % (i + 1, bleu_score)
-            if bleu_score > best_score:
-                best_score = bleu_score
-                option["indices"] = reader.get_indices()
-                option["bleu"] = best_score
-                option["cost"] = totcost
-                option["count"] = [count, reader.count]
-                serialize(bestname, option)
-
-        print "averaged cost: ", totcost / count
-        print "--------------------------------------------------"
-
-        # early stopping
-        if i + 1 >= option["stop"]:
-            alpha = alpha * option["decay"]
-
-        count = 0
-        totcost = 0.0
-        stream.reset()
-
-        # update autosave
-        option["epoch"] = i + 1
-        option["alpha"] = alpha
-        option["indices"] = reader.get_indices()
-        option["bleu"] = best_score
-        option["cost"] = totcost
-        option["count"] = [0, 0]
-        serialize(autoname, option)
-
-    print "best(bleu): %2.4f" % best_score
+    try:
+        for i in range(epoch, maxepoch):
+            # tokens and padded size of source and target
+            ntoken = [0.0, 0.0]
+            npad = [0.0, 0.0]
+
+            for data, xdata, xmask, ydata, ymask in stream:
+                ntoken[0] += xmask.sum()
+                ntoken[1] += ymask.sum()
+                npad[0] += xmask.size
+                npad[1] += ymask.size
+
+                if criterion == "mrt":
+                    refs = []
+
+                    for item in data[1]:
+                        item = to_text(item, itvocab).split()
+                        item = [unk_sym if word not in tvocab else word
+                                for word in item]
+                        refs.append(" ".join(item))
+
+                    t1 = time.time()
+
+                    # sample from model
+                    nsample = option["sample"] - len(refs)
+                    xdata = numpy.repeat(xdata, nsample, 1)
+                    xmask = numpy.repeat(xmask, nsample, 1)
+                    maxlen = int(1.5 * len(ydata))
+                    examples = batchsample(model, xdata, xmask, maxlen)
+                    space = build_sample_space(refs, examples)
+                    score = numpy.zeros((len(space),), "float32")
+
+                    refs = [ref.split() for ref in refs]
+
+                    for j in range(len(space)):
+                        example = space[j].split()
+                        score[j] = 1.0 - bleu([example], [refs],
+                                              smoothing=True)
+
+                    ydata, ymask = convert_data(space, tvocab, unk_sym,
+                                                eos_sym)
+                    cost, norm = step(xdata[:, 0:1], xmask[:, 0:1], ydata,
+                                      ymask, score, sharp, alpha=alpha)
+                    t2 = time.time()
+
+                    totcost += cost
+                    count += 1
+                    t = t2 - t1
+                    ac = totcost / count
+                    print i + 1, count, len(space), cost, norm, ac, t
+                else:
+                    t1 = time.time()
+
+                    if option["sampled_softmax"]:
+                        nsample = option["sampled_softmax"]
+                        outputs = sample_candidates(ydata, len(itvocab),
+                                                    nsample)
+                        cost, norm = step(xdata, xmask, ydata, ymask,
+                                          *outputs, alpha=alpha)
+                    else:
+                        cost, norm = step(xdata, xmask, ydata, ymask,
+                                          alpha=alpha)
+
+                    t2 = time.time()
+
+                    count += 1
+                    cost = cost * ymask.shape[1] / ymask.sum()
+                    totcost += cost / math.log(2)
+                    print i + 1, count, cost, norm, t2 - t1
+
+                # autosave
+                if count % option["freq"] == 0:
+                    option["indices"] = stream.get_indices()
+                    option["bleu"] = best_score
+                    option["cost"] = totcost
+                    option["count"] = [count, stream.count]
+                    writer.save(autoname, *snapshot(option, state))
+
+                    if keep:
+                        name = get_numbered_name(pathname, modelname,
+                                                 option["epoch"], count)
+                        writer.save_numbered(name, autoname)
+
+                if count % option["vfreq"] == 0:
+                    if option["validation"] and references:
+                        trans = translate(model, option["validation"],
+                                          **search_opt)
+                        bleu_score = bleu(trans, references)
+                        print "bleu: %2.4f" % bleu_score
+                        if bleu_score > best_score:
+                            best_score = bleu_score
+                            option["indices"] = stream.get_indices()
+                            option["bleu"] = best_score
+                            option["cost"] = totcost
+                            option["count"] = [count, stream.count]
+                            writer.save(bestname, *snapshot(option, state))
+
+                if count % option["sfreq"] == 0:
+                    n = len(data[0])
+                    ind = numpy.random.randint(0, n)
+                    sdata = to_text(data[0][ind], isvocab)
+                    tdata = to_text(data[1][ind], itvocab)
+                    xdata = xdata[:, ind : ind + 1]
+                    xmask = xmask[:, ind : ind + 1]
+                    hls = beamsearch(model, xdata, xmask)
+                    best, score = hls[0]
+                    print sdata
+                    print tdata
+                    print " ".join(best[:-1])
+
+
+            print "--------------------------------------------------"
+
+            if option["validation"] and references:
+                trans = translate(model, option["validation"], **search_opt)
+                bleu_score = bleu(trans, references)
+                print "iter: %d, bleu: %2.4f" % (i + 1, bleu_score)
+                if bleu_score > best_score:
+                    best_score = bleu_score
+                    option["indices"] = stream.get_indices()
+                    option["bleu"] = best_score
+                    option["cost"] = totcost
+                    option["count"] = [count, stream.count]
+                    writer.save(bestname, *snapshot(option, state))
+
+            print "averaged cost: ", totcost / count
+            print "data wait: %.2fs" % stream.wait_time
+
+            if npad[0]:
+                efficiency = (ntoken[0] / npad[0], ntoken[1] / npad[1])
+                print "padding efficiency: %.4f %.4f" % efficiency
+            print "--------------------------------------------------"
+
+            # early stopping
+            if i + 1 >= option["stop"]:
+                alpha = alpha * option["decay"]
+
+            count = 0
+            totcost = 0.0
+            stream.reset()
+
+            # update autosave
+            option["epoch"] = i + 1
+            option["alpha"] = alpha
+            option["indices"] = stream.get_indices()
+            option["bleu"] = best_score
+            option["cost"] = totcost
+            option["count"] = [0, 0]
+            writer.save(autoname, *snapshot(option, state))
+
+            if keep:
+                name = get_numbered_name(pathname, modelname, i + 1, 0)
+                writer.save_numbered(name, autoname)
+
+        print "best(bleu): %2.4f" % best_score
+    finally:
+        # pending checkpoints are written even if training fails
+        writer.close()
+
+    if nproc > 1:
+        workers.close()
 
     stream.close()
 
@@ -912,12 +1267,30 @@ def decode(args):
     num_models = len(args.model)
     models = [None for i in range(num_models)]
 
+    # only compile the functions used by batched_beamsearch
+    if args.topk and num_models == 1 and not args.shortlist:
+        functions = ["encode", "predict_topk", "step_topk"]
+    elif args.shortlist:
+        functions = ["encode", "predict_shortlist", "step_shortlist"]
+    else:
+        functions = ["encode", "predict", "step"]
+
     for i in range(num_models):
         option, params = load_model(args.model[i])
+
+        if args.numpy:
+            models[i] = numpy_rnnsearch(option, params)
+            continue
+
         scope = "rnnsearch_%d" % i
-        model = rnnsearch(scope=scope, **option)
+
+        with ops.deferred_initialization():
+            model = rnnsearch(scope=scope, cache=args.cache, **option)
+
         var_list = get_variables_with_prefix(scope)
         set_variables(var_list, params)
+        ops.initialize_variables(var_list)
+        model.compile(*functions)
         models[i] = model
 
     # use the first model
@@ -936,6 +1309,13 @@ def decode(args):
     option["beamsize"] = args.beamsize
     option["normalize"] = args.normalize
     option["arithmetic"] = args.arithmetic
+    option["topk"] = args.topk
+
+    if args.shortlist:
+        lexicon = load_lexicon(args.shortlist, args.ntrans)
+        extra_ids = [models[0].option["eosid"], tvocab[unk_sym]]
+    else:
+        lexicon = None
 
     if args.oracle:
         references = load_references(args.oracle)
@@ -943,55 +1323,73 @@ def decode(args):
         references = None
 
     while True:
-        line = sys.stdin.readline()
+        data = []
 
-        if line == "":
+        while len(data) < args.batch:
+            line = sys.stdin.readline()
+
+            if line == "":
+                break
+
+            data.append(line)
+
+        if not data:
             break
 
-        data = [line]
         seq, mask = convert_data(data, svocab, unk_sym, eos_sym)
         t1 = time.time()
-        tlist = beamsearch(models, seq, **option)
+
+        if lexicon is not None:
+            option["candidates"] = build_shortlist(data, lexicon, tvocab,
+                                                   args.nfreq, extra_ids)
+
+        tlists = batched_beamsearch(models, seq, mask, **option)
         t2 = time.time()
 
-        if len(tlist) == 0:
-            translation = ""
-            score = -10000.0
-        else:
-            if references is None:
-                best, score = tlist[0]
-                translation = " ".join(best[:-1])
-                sys.stdout.write(translation)
-                sys.stdout.write("\n")
+        for tlist in tlists:
+            if len(tlist) == 0:
+                translation = ""
+                score = -10000.0
             else:
-                best_ind = 0
-                best_score = 0
-                # find the best translation according to oracle
-                for i, (trans, score) in enumerate(tlist):
-                    trans = trans[:-1]
-                    bleu_score = bleu([trans], [references[count]],
-                                      smoothing=True)
-                    if bleu_score > best_score:
-                        best_score = bleu_score
-                        best_ind = i
-
-                output = " ".join(tlist[0][0][:-1]) + " ||| "
-                output += str(tlist[0][1]) + " ||| " + str(best_ind) + " ||| "
-                output += " ".join(tlist[best_ind][0][:-1]) + " ||| "
-                output += str(tlist[best_ind][1])
-
-                sys.stdout.write(output)
-                sys.stdout.write("\n")
-
-        count = count + 1
-        sys.stderr.write(str(count) + " ")
-        sys.stderr.write(str(score) + " " + str(t2 - t1) + "\n")
+                if references is None:
+                    best, score = tlist[0]
+                    translation = " ".join(best[:-1])
+                    sys.stdout.write(translation)
+                    sys.stdout.write("\n")
+                else:
+                    best_ind = 0
+                    best_score = 0
+                    # find the best translation according to oracle
+                    for i, (trans, score) in enumerate(tlist):
+                        trans = trans[:-1]
+                        bleu_score = bleu([trans], [references[count]],
+                                          smoothing=True)
+                        if bleu_score > best_score:
+                            best_score = bleu_score
+                            best_ind = i
+
+                    output = " ".join(tlist[0][0][:-1]) + " ||| "
+                    output += str(tlist[0][1]) + " ||| "
+                    output += str(best_ind) + " ||| "
+                    output += " ".join(tlist[best_ind][0][:-1]) + " ||| "
+                    output += str(tlist[best_ind][1])
+
+                    sys.stdout.write(output)
+                    sys.stdout.write("\n")
+
+            count = count + 1
+            sys.stderr.write(str(count) + " ")
+            sys.stderr.write(str(score) + " " + str(t2 - t1) + "\n")
 
 
 def sample(args):
     option, values = load_model(args.model)
-    model = rnnsearch(**option)
+    with ops.deferred_initialization():
+        model = rnnsearch(cache=args.cache, **option)
+
     set_variables(ops.trainable_variables(), values)
+    ops.initialize_variables()
+    model.compile("sample")
 
     svocabs, tvocabs = model.option["vocabulary"]
     unk_symbol = model.option["unk"]
@@ -1048,9 +1446,13 @@ def replace(args):
     for i in range(num_models):
         option, params = load_model(args.model[i])
         scope = "rnnsearch_%d" % i
-        model = rnnsearch(scope=scope, **option)
+        with ops.deferred_initialization():
+            model = rnnsearch(scope=scope, cache=args.cache, **option)
+
         var_list = get_variables_with_prefix(scope)
         set_variables(var_list, params)
+        ops.initialize_variables(var_list)
+        model.compile("align")
         models[i] = model
 
     # use the first model
@@ -1125,9 +1527,13 @@ def replace(args):
 
 def evaluate(args):
     option, params = load_model(args.model)
-    model = rnnsearch(**option)
+    with ops.deferred_initialization():
+        model = rnnsearch(cache=args.cache, **option)
+
     var_list = ops.trainable_variables()
     set_variables(var_list, params)
+    ops.initialize_variables(var_list)
+    model.compile("encode", "predict", "generate")
 
     # use the first model
     svocabs, tvocabs = model.option["vocabulary"]
@@ -1166,6 +1572,18 @@ def evaluate(args):
     stream.close()
 
 
+def binarize_corpus(args):
+    if not len(args.corpus) == len(args.vocab) == len(args.output):
+        raise ValueError("--corpus, --vocab and --output must match")
+
+    for name, vocab, output in zip(args.corpus, args.vocab, args.output):
+        voc = load_vocab(vocab)
+        # same as the vocabulary used in training
+        voc[args.eos] = len(invert_vocab(voc))
+        nline, ntoken = binarize(name, output, voc, args.unk, args.eos)
+        print "%s: %d sentences, %d tokens" % (output, nline, ntoken)
+
+
 def helpinfo():
     print "usage:"
     print "\trnnsearch.py <command> [<args>]"
@@ -1174,6 +1592,7 @@ def helpinfo():
     print "use 'rnnsearch.py sample' --help to see sampling options"
     print "use 'rnnsearch.py replace' --help to see UNK replacement options"
     print "use 'rnnsearch.py evaluate --help' to see evaluation options"
+    print "use 'rnnsearch.py binarize --help' to see binarization options"
 
 
 if __name__ == "__main__":
@@ -1206,5 +1625,10 @@ if __name__ == "__main__":
             sys.stderr.write("\n")
             args = parseargs_evaluate(sys.argv[2:])
             evaluate(args)
+        elif command == "binarize":
+            sys.stderr.write(" ".join(sys.argv))
+            sys.stderr.write("\n")
+            args = parseargs_binarize(sys.argv[2:])
+            binarize_corpus(args)
         else:
             helpinfo()
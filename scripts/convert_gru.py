@@ -0,0 +1,88 @@
+# convert_gru.py
+# convert gru_cell weights to fused_gru_cell weights
+# author: Playinf
+# email: playinf@stu.xmu.edu.cn
+
+import os
+import sys
+import numpy
+
+# model files are read and written by rnnsearch.py
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rnnsearch import load_model, serialize
+
+
+def get_matrices(params, prefix, gate):
+    matrices = []
+    i = 0
+
+    while True:
+        key = "%s/%s/matrix_%d" % (prefix, gate, i)
+        if key not in params:
+            break
+        matrices.append(params[key])
+        i += 1
+
+    return matrices
+
+
+# [sum(input_size) + hid, 3 * hid], columns: reset, update, candidate
+def fuse_gru(params, prefix):
+    reset = get_matrices(params, prefix, "reset_gate")
+    update = get_matrices(params, prefix, "update_gate")
+    candidate = get_matrices(params, prefix, "candidate")
+    bias = params[prefix + "/candidate/bias"]
+
+    rows = []
+
+    for r, u, c in zip(reset, update, candidate):
+        rows.append(numpy.concatenate([r, u, c], 1))
+
+    matrix = numpy.concatenate(rows, 0)
+    # gates of gru_cell have no bias
+    zeros = numpy.zeros_like(bias)
+    bias = numpy.concatenate([zeros, zeros, bias], 0)
+
+    return matrix, bias
+
+
+def convert(params):
+    names = [n for n, v in params]
+    params = dict(params)
+    new_params = []
+    fused = set()
+
+    for name in names:
+        if "/gru_cell/" not in name:
+            new_params.append((name, params[name]))
+            continue
+
+        prefix = name[:name.index("/gru_cell/") + len("/gru_cell")]
+        new_prefix = prefix[:-len("gru_cell")] + "fused_gru_cell/gates"
+
+        # keep the position of the first variable of each cell
+        if new_prefix in fused:
+            continue
+
+        fused.add(new_prefix)
+        matrix, bias = fuse_gru(params, prefix)
+        new_params.append((new_prefix + "/matrix", matrix))
+        new_params.append((new_prefix + "/bias", bias))
+
+    return new_params
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print "usage: convert_gru.py input output"
+        sys.exit(-1)
+
+    opt, params = load_model(sys.argv[1])
+
+    if opt.get("cell", "gru") != "gru":
+        raise ValueError("model is not built with gru_cell")
+
+    params = convert(params)
+    opt["cell"] = "fused_gru"
+    serialize(sys.argv[2], opt, params=params)
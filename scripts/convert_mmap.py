@@ -0,0 +1,41 @@
+# convert_mmap.py
+# convert pickled checkpoints to the memory-mapped format of
+# utils/checkpoint.py
+# author: Playinf
+# email: playinf@stu.xmu.edu.cn
+
+import os
+import sys
+import numpy
+
+# model files are read and written by rnnsearch.py
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rnnsearch import load_model
+from utils.checkpoint import save_mmap, load_mmap
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print "usage: convert_mmap.py input output"
+        sys.exit(-1)
+
+    opt, params = load_model(sys.argv[1])
+
+    # not a model parameter
+    if opt.get("indices") is not None:
+        params = params + [("indices", opt["indices"])]
+        opt["indices"] = None
+
+    save_mmap(sys.argv[2], opt, params)
+
+    # the written file must read back exactly
+    tensors = load_mmap(sys.argv[2])[1]
+
+    if [n for n, v in tensors] != [n for n, v in params]:
+        raise RuntimeError("%s: tensor names do not match" % sys.argv[2])
+
+    for (n, v1), (_, v2) in zip(params, tensors):
+        if v1.dtype != v2.dtype or not numpy.array_equal(v1, v2):
+            raise RuntimeError("%s: %s is not stored correctly"
+                               % (sys.argv[2], n))
@@ -12,7 +12,11 @@ def find_nbest(score, n, threshold=None):
     num_vars = score.shape[1]
 
     score = score.flatten()
-    nbest = np.argpartition(score, n)[:n]
+
+    if n >= len(score):
+        nbest = np.arange(len(score))
+    else:
+        nbest = np.argpartition(score, n)[:n]
 
     beam_indices = nbest / num_vars
     var_indices = nbest % num_vars
@@ -28,33 +32,70 @@ def find_nbest(score, n, threshold=None):
     return nbest_score, beam_indices, var_indices
 
 
+# hypotheses are stored in preallocated arrays:
+# words[t, i]: the t-th word of the i-th hypothesis alive at step t
+# pointers[t, i]: position of its prefix in row t - 1
+# a hypothesis is only reconstructed by backtracking when it finishes
 class beam:
 
-    def __init__(self, beamsize, threshold=None):
+    def __init__(self, beamsize, maxlen, bosid=0, threshold=None,
+                 dtype="float32"):
         self.size = beamsize
         self.threshold = threshold
-        self.score = []
-        self.candidate = []
-
-    def prune(self, dist, cond, prev_beam):
-        prev_score = np.array(prev_beam.score, dist.dtype)
-        score = prev_score[:, None] - dist
+        self.step = 0
+        self.words = np.zeros([maxlen + 1, beamsize], "int32")
+        self.pointers = np.zeros([maxlen + 1, beamsize], "int32")
+        self.words[0, 0] = bosid
+        self.score = np.zeros([1], dtype)
+
+    def __len__(self):
+        return len(self.score)
+
+    # last words of alive hypotheses
+    @property
+    def last_words(self):
+        return self.words[self.step, :len(self)]
+
+    # words: a [len, n] matrix ending at the current step
+    def backtrack(self, last_words, indices):
+        step = self.step
+        words = np.zeros([step + 2, len(indices)], "int32")
+        words[-1] = last_words
+
+        for t in range(step, -1, -1):
+            words[t] = self.words[t, indices]
+            indices = self.pointers[t, indices]
+
+        return words
+
+    # dist: log probabilities of alive hypotheses, [len(self), num_vars]
+    # indices: word ids of columns of dist, either shared by all hypotheses
+    # or given for each hypothesis, all words if not provided
+    def prune(self, dist, eosid, indices=None):
+        score = self.score[:, None] - dist
 
         outputs = find_nbest(score, self.size, self.threshold)
         nbest_score, beam_indices, var_indices = outputs
 
-        finished = []
-        remained = []
+        if indices is not None and indices.ndim == 1:
+            var_indices = indices[var_indices]
+        elif indices is not None:
+            var_indices = indices[beam_indices, var_indices]
+
+        cond = var_indices == eosid
+        remained = np.logical_not(cond)
+        words = self.backtrack(var_indices[cond], beam_indices[cond])
+        finished = [[list(words[:, i]), s]
+                    for i, s in enumerate(nbest_score[cond])]
 
-        for i, (bid, vid) in enumerate(zip(beam_indices, var_indices)):
-            prev_candidate = prev_beam.candidate
-            candidate = prev_candidate[bid] + [vid]
+        beam_indices = beam_indices[remained]
+        var_indices = var_indices[remained]
+        num = len(var_indices)
 
-            if cond(candidate):
-                finished.append([candidate, nbest_score[i]])
-            else:
-                remained.append(i)
-                self.candidate.append(candidate)
-                self.score.append(nbest_score[i])
+        self.step += 1
+        self.size -= len(finished)
+        self.words[self.step, :num] = var_indices
+        self.pointers[self.step, :num] = beam_indices
+        self.score = nbest_score[remained]
 
-        return finished, beam_indices[remained], var_indices[remained]
+        return finished, beam_indices, var_indices
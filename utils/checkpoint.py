@@ -0,0 +1,268 @@
+# checkpoint.py
+# checkpoint formats and writers
+# author: Playinf
+# email: playinf@stu.xmu.edu.cn
+#
+# memory-mapped checkpoint layout:
+#   magic (8 bytes) | header size (8 bytes, little endian) | header | tensors
+# header is a pickled dictionary:
+#   {"option": option, "tensors": [(name, dtype, shape, offset), ...]}
+# offsets are relative to the end of the header, every tensor is stored in
+# C order and aligned to 64 bytes
+
+import os
+import sys
+import errno
+import numpy
+import Queue
+import shutil
+import struct
+import cPickle
+import binascii
+import threading
+
+
+__all__ = ["is_mmap_checkpoint", "save_mmap", "create_mmap", "load_mmap",
+           "atomic_save", "atomic_copy", "checkpoint_writer"]
+
+
+MAGIC = "RNNMMAP1"
+ALIGNMENT = 64
+
+
+def align(n):
+    return (n + ALIGNMENT - 1) / ALIGNMENT * ALIGNMENT
+
+
+def is_mmap_checkpoint(name):
+    fd = open(name, "rb")
+    magic = fd.read(len(MAGIC))
+    fd.close()
+
+    return magic == MAGIC
+
+
+# specs: a list of (name, dtype, shape)
+# returns the offset of the first tensor and the size of the file
+def write_header(fd, option, specs):
+    offset = 0
+    infos = []
+
+    for key, dtype, shape in specs:
+        dtype = numpy.dtype(dtype)
+        shape = tuple(shape)
+        infos.append((key, dtype.str, shape, offset))
+        offset = align(offset + int(numpy.prod(shape)) * dtype.itemsize)
+
+    header = {"option": option, "tensors": infos}
+    header = cPickle.dumps(header, cPickle.HIGHEST_PROTOCOL)
+    start = align(len(MAGIC) + 8 + len(header))
+
+    fd.write(MAGIC)
+    fd.write(struct.pack("<Q", len(header)))
+    fd.write(header)
+
+    return start, start + offset
+
+
+# tensors: a list of (name, numpy.ndarray)
+def save_mmap(name, option, tensors):
+    arrays = [numpy.ascontiguousarray(val) for key, val in tensors]
+    specs = [(key, val.dtype, val.shape)
+             for (key, _), val in zip(tensors, arrays)]
+
+    fd = open(name, "wb")
+    start, size = write_header(fd, option, specs)
+    offset = start
+
+    for val in arrays:
+        fd.seek(offset)
+        fd.write(val.tobytes())
+        offset = start + align(offset - start + val.nbytes)
+
+    # keeps the file size a multiple of the alignment, the last tensor may
+    # already end there
+    fd.truncate(size)
+    fd.close()
+
+
+# creates a file of zero-filled tensors, returns the tensors opened for
+# writing, same as load_mmap(name, "r+")
+def create_mmap(name, option, specs):
+    fd = open(name, "wb")
+    start, size = write_header(fd, option, specs)
+    fd.truncate(size)
+    fd.close()
+
+    return load_mmap(name, "r+")[1]
+
+
+# mode: "r" shares pages between processes, "c" is copy-on-write
+# returns option, [(name, numpy.memmap)]
+def load_mmap(name, mode="r"):
+    fd = open(name, "rb")
+
+    if fd.read(len(MAGIC)) != MAGIC:
+        fd.close()
+        raise ValueError("%s is not a memory-mapped checkpoint" % name)
+
+    size = struct.unpack("<Q", fd.read(8))[0]
+    header = cPickle.loads(fd.read(size))
+    fd.close()
+
+    start = align(len(MAGIC) + 8 + size)
+    tensors = []
+
+    for key, dtype, shape, offset in header["tensors"]:
+        dtype = numpy.dtype(dtype)
+
+        if numpy.prod(shape) == 0:
+            val = numpy.zeros(shape, dtype)
+        else:
+            val = numpy.memmap(name, dtype, mode, start + offset, shape)
+
+        tensors.append((key, val))
+
+    return header["option"], tensors
+
+
+# unique file next to name, created with the permissions of open
+def temp_name(name):
+    while True:
+        suffix = binascii.hexlify(os.urandom(4))
+        tmpname = "%s.%s.tmp" % (os.path.abspath(name), suffix)
+
+        try:
+            fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                continue
+            raise
+
+        return fd, tmpname
+
+
+# save(fd, *args) writes to a temporary file in the same directory, which
+# replaces name only after it is flushed to disk, an interrupted save never
+# leaves a partially written file behind
+def atomic_save(name, save, *args):
+    fd, tmpname = temp_name(name)
+    fd = os.fdopen(fd, "wb")
+
+    try:
+        save(fd, *args)
+        fd.flush()
+        os.fsync(fd.fileno())
+        fd.close()
+        os.rename(tmpname, name)
+    except BaseException:
+        fd.close()
+        os.remove(tmpname)
+        raise
+
+
+# replaces name with a hard link to source, or a copy if links are not
+# supported
+def atomic_copy(source, name):
+    fd, tmpname = temp_name(name)
+    os.close(fd)
+    os.remove(tmpname)
+
+    try:
+        try:
+            os.link(source, tmpname)
+        except OSError:
+            shutil.copyfile(source, tmpname)
+        os.rename(tmpname, name)
+    except BaseException:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+
+
+# writes checkpoints in a background thread
+# save: same as atomic_save
+# keep: number of numbered checkpoints retained, 0 to retain all
+# numbered: existing numbered checkpoints, oldest first
+# maxsize: pending checkpoints, bounds the memory used by snapshots
+class checkpoint_writer(object):
+
+    def __init__(self, save, keep=0, numbered=None, maxsize=2):
+        self._save = save
+        self._keep = keep
+        self._numbered = list(numbered or [])
+        self._queue = Queue.Queue(maxsize)
+        self._error = None
+        # names whose latest save failed
+        self._failed = set()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+
+            if item is None:
+                self._queue.task_done()
+                break
+
+            name, numbered, args = item
+
+            try:
+                if numbered and args[0] in self._failed:
+                    # source holds an older state, which is not published
+                    sys.stderr.write("skip %s: %s is not saved\n"
+                                     % (name, args[0]))
+                elif numbered:
+                    atomic_copy(args[0], name)
+                    self._remove_old(name)
+                else:
+                    self._failed.add(name)
+                    atomic_save(name, self._save, *args)
+                    self._failed.discard(name)
+            except Exception as e:
+                sys.stderr.write("cannot save %s: %s\n" % (name, e))
+                self._error = e
+
+            self._queue.task_done()
+
+    def _remove_old(self, name):
+        if name in self._numbered:
+            self._numbered.remove(name)
+
+        self._numbered.append(name)
+
+        if not self._keep:
+            return
+
+        while len(self._numbered) > self._keep:
+            oldname = self._numbered.pop(0)
+            if os.path.exists(oldname):
+                os.remove(oldname)
+
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    # args: a snapshot, must not be modified after calling save
+    def save(self, name, *args):
+        self._check()
+        self._queue.put((name, False, args))
+
+    # a copy of source, which is written by a previous save, subject to the
+    # retention policy, skipped if that save fails
+    def save_numbered(self, name, source):
+        self._check()
+        self._queue.put((name, True, (source,)))
+
+    # blocks until all pending checkpoints are written
+    def wait(self):
+        self._queue.join()
+        self._check()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._check()